@@ -2,10 +2,12 @@
 
 -- Enable UUID extension
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 -- Shops table
 CREATE TABLE IF NOT EXISTS shops (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     name TEXT NOT NULL,
     description TEXT,
     logo_url TEXT,
@@ -26,14 +28,14 @@ CREATE TABLE IF NOT EXISTS shops (
 
 -- Menu items table
 CREATE TABLE IF NOT EXISTS menu_items (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     shop_id TEXT REFERENCES shops(id) ON DELETE CASCADE,
     name TEXT NOT NULL,
     description TEXT,
     category TEXT NOT NULL,
     base_price DECIMAL NOT NULL,
     image_url TEXT,
-    customization_options JSONB,
+    customization_options JSONB NOT NULL DEFAULT '{}'::JSONB,
     is_available BOOLEAN DEFAULT true,
     is_featured BOOLEAN DEFAULT false,
     sort_order INTEGER DEFAULT 0,
@@ -42,7 +44,7 @@ CREATE TABLE IF NOT EXISTS menu_items (
 
 -- Orders table
 CREATE TABLE IF NOT EXISTS orders (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     order_number TEXT UNIQUE,
     user_id TEXT NOT NULL,
     shop_id TEXT REFERENCES shops(id),
@@ -63,7 +65,7 @@ CREATE TABLE IF NOT EXISTS orders (
 
 -- Loyalty transactions table
 CREATE TABLE IF NOT EXISTS loyalty_transactions (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     user_id TEXT NOT NULL,
     shop_id TEXT REFERENCES shops(id),
     order_id TEXT REFERENCES orders(id),
@@ -106,16 +108,17 @@ CREATE TABLE IF NOT EXISTS reviews (
 
 -- Wallets table
 CREATE TABLE IF NOT EXISTS wallets (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     user_id TEXT UNIQUE NOT NULL,
     balance DECIMAL DEFAULT 0,
+    stripe_customer_id TEXT,
     created_at TIMESTAMPTZ DEFAULT NOW(),
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
 -- Wallet transactions table
 CREATE TABLE IF NOT EXISTS wallet_transactions (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     user_id TEXT NOT NULL,
     amount DECIMAL NOT NULL,
     type TEXT NOT NULL,
@@ -125,21 +128,542 @@ CREATE TABLE IF NOT EXISTS wallet_transactions (
     created_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Running loyalty point balance per user, maintained by a trigger on loyalty_transactions
+CREATE TABLE IF NOT EXISTS user_loyalty (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Gift cards sent between users
+CREATE TABLE IF NOT EXISTS gifts (
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
+    sender_id TEXT NOT NULL,
+    recipient_email TEXT NOT NULL,
+    amount DECIMAL NOT NULL,
+    message TEXT,
+    code TEXT UNIQUE,
+    status TEXT DEFAULT 'pending',
+    redeemed_by TEXT,
+    redeemed_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- In-app notifications
+CREATE TABLE IF NOT EXISTS notifications (
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    message TEXT,
+    type TEXT,
+    data JSONB,
+    read BOOLEAN DEFAULT false,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Reward vouchers issued when loyalty points are redeemed
+CREATE TABLE IF NOT EXISTS reward_vouchers (
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
+    user_id TEXT NOT NULL,
+    reward_type TEXT NOT NULL,
+    code TEXT UNIQUE,
+    status TEXT DEFAULT 'active',
+    expires_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
 ALTER TABLE wallet_transactions ADD COLUMN IF NOT EXISTS payment_intent_id TEXT;
+ALTER TABLE shops ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE menu_items ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE orders ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE loyalty_transactions ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE wallets ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE wallet_transactions ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE notifications ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE notifications ALTER COLUMN created_at SET DEFAULT NOW();
+ALTER TABLE reward_vouchers ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE reward_vouchers ALTER COLUMN created_at SET DEFAULT NOW();
+ALTER TABLE wallets ADD COLUMN IF NOT EXISTS stripe_customer_id TEXT;
+UPDATE menu_items SET customization_options = '{}'::JSONB WHERE customization_options IS NULL;
+ALTER TABLE menu_items ALTER COLUMN customization_options SET DEFAULT '{}'::JSONB;
+ALTER TABLE menu_items ALTER COLUMN customization_options SET NOT NULL;
+ALTER TABLE wallets DROP COLUMN IF EXISTS lock_version;
+ALTER TABLE user_loyalty DROP COLUMN IF EXISTS version;
 
 -- Create indexes for better query performance
 CREATE INDEX IF NOT EXISTS idx_menu_items_shop_id ON menu_items(shop_id);
 CREATE INDEX IF NOT EXISTS idx_menu_items_category ON menu_items(category);
+CREATE INDEX IF NOT EXISTS idx_shops_name_trgm ON shops USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_shops_description_trgm ON shops USING gin (description gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_shops_address_trgm ON shops USING gin (address gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_menu_items_name_trgm ON menu_items USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_menu_items_description_trgm ON menu_items USING gin (description gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_menu_items_category_trgm ON menu_items USING gin (category gin_trgm_ops);
 CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id);
+CREATE INDEX IF NOT EXISTS idx_orders_user_status_created ON orders(user_id, status, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_orders_shop_id ON orders(shop_id);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
 CREATE INDEX IF NOT EXISTS idx_loyalty_user_id ON loyalty_transactions(user_id);
 CREATE INDEX IF NOT EXISTS idx_wallets_user_id ON wallets(user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_wallets_stripe_customer_id
+ON wallets(stripe_customer_id)
+WHERE stripe_customer_id IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_wallet_transactions_user_id ON wallet_transactions(user_id);
+CREATE INDEX IF NOT EXISTS idx_wallet_tx_user_created ON wallet_transactions(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_gifts_sender_created ON gifts(sender_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_gifts_recipient_created ON gifts(recipient_email, created_at DESC);
 CREATE UNIQUE INDEX IF NOT EXISTS idx_wallet_tx_payment_intent_id
 ON wallet_transactions(payment_intent_id)
 WHERE payment_intent_id IS NOT NULL;
 
+-- Total loyalty points for a user, read from the running balance
+CREATE OR REPLACE FUNCTION user_points(uid TEXT)
+RETURNS INTEGER
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE((SELECT balance FROM user_loyalty WHERE user_id = uid), 0);
+$$;
+
+-- Wallet balance (created on first access) with the 20 most recent transactions
+CREATE OR REPLACE FUNCTION get_wallet_with_tx(uid TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO wallets (id, user_id, balance)
+    VALUES (gen_random_uuid()::TEXT, uid, 0)
+    ON CONFLICT (user_id) DO NOTHING;
+
+    RETURN (
+        SELECT jsonb_build_object(
+            'balance', w.balance,
+            'transactions', COALESCE((
+                SELECT jsonb_agg(t ORDER BY t.created_at DESC)
+                FROM (
+                    SELECT id, amount, type, description, order_id, created_at
+                    FROM wallet_transactions
+                    WHERE user_id = uid
+                    ORDER BY created_at DESC
+                    LIMIT 20
+                ) t
+            ), '[]'::JSONB)
+        )
+        FROM wallets w
+        WHERE w.user_id = uid
+    );
+END;
+$$;
+
+-- Create an order and its loyalty earn transaction in a single transaction
+CREATE OR REPLACE FUNCTION place_order(p_order JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_order orders;
+BEGIN
+    new_order := jsonb_populate_record(NULL::orders, p_order);
+    new_order.id := COALESCE(new_order.id, gen_random_uuid()::TEXT);
+    new_order.order_number := COALESCE(new_order.order_number, 'ORD-' || upper(encode(gen_random_bytes(3), 'hex')));
+    new_order.shop_name := COALESCE((SELECT name FROM shops WHERE id = new_order.shop_id), 'Unknown Shop');
+    new_order.status := 'pending';
+    new_order.points_earned := COALESCE(new_order.points_earned, 0);
+    new_order.created_at := COALESCE(new_order.created_at, NOW());
+    new_order.updated_at := COALESCE(new_order.updated_at, new_order.created_at);
+
+    INSERT INTO orders SELECT new_order.*;
+
+    IF new_order.points_earned > 0 THEN
+        INSERT INTO loyalty_transactions (id, user_id, shop_id, order_id, points_change, transaction_type, description, created_at)
+        VALUES (
+            gen_random_uuid()::TEXT,
+            new_order.user_id,
+            new_order.shop_id,
+            new_order.id,
+            new_order.points_earned,
+            'earn',
+            'Order #' || new_order.order_number,
+            new_order.created_at
+        );
+    END IF;
+
+    RETURN to_jsonb(new_order);
+END;
+$$;
+
+-- Debit a wallet only if it holds enough funds; returns the new balance, or NULL when it doesn't
+CREATE OR REPLACE FUNCTION wallet_debit(uid TEXT, amt NUMERIC)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    IF amt IS NULL OR amt <= 0 THEN
+        RAISE EXCEPTION 'Debit amount must be greater than 0';
+    END IF;
+
+    UPDATE wallets
+    SET balance = balance - amt,
+        updated_at = NOW()
+    WHERE user_id = uid AND balance >= amt
+    RETURNING balance INTO new_balance;
+
+    RETURN new_balance;
+END;
+$$;
+
+-- Credit a wallet, creating it on first use; returns the new balance
+CREATE OR REPLACE FUNCTION wallet_credit(uid TEXT, amt NUMERIC)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    IF amt IS NULL OR amt <= 0 THEN
+        RAISE EXCEPTION 'Credit amount must be greater than 0';
+    END IF;
+
+    INSERT INTO wallets (id, user_id, balance)
+    VALUES (gen_random_uuid()::TEXT, uid, amt)
+    ON CONFLICT (user_id) DO UPDATE
+    SET balance = wallets.balance + EXCLUDED.balance,
+        updated_at = NOW()
+    RETURNING balance INTO new_balance;
+
+    RETURN new_balance;
+END;
+$$;
+
+-- Credit a Stripe top-up and record its wallet transaction in one transaction.
+-- Idempotent per payment intent: a repeat call returns the recorded transaction
+-- and current balance with applied = false instead of crediting twice.
+DROP FUNCTION IF EXISTS topup_and_log(TEXT, NUMERIC, TEXT);
+CREATE OR REPLACE FUNCTION topup_and_log(p_user TEXT, p_amount NUMERIC, p_pi TEXT)
+RETURNS TABLE(new_balance NUMERIC, tx_id TEXT, applied BOOLEAN)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description, payment_intent_id)
+    VALUES (gen_random_uuid()::TEXT, p_user, p_amount, 'topup', 'Added $' || to_char(p_amount, 'FM999999990.00') || ' to wallet', p_pi)
+    ON CONFLICT (payment_intent_id) WHERE payment_intent_id IS NOT NULL DO NOTHING
+    RETURNING id INTO tx_id;
+
+    applied := tx_id IS NOT NULL;
+    IF applied THEN
+        new_balance := wallet_credit(p_user, p_amount);
+    ELSE
+        SELECT t.id INTO tx_id FROM wallet_transactions t WHERE t.payment_intent_id = p_pi;
+        SELECT w.balance INTO new_balance FROM wallets w WHERE w.user_id = p_user;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$;
+
+-- Debit a wallet for an order and record the payment in one transaction; NULL when funds are short
+CREATE OR REPLACE FUNCTION pay_and_log(uid TEXT, amt NUMERIC, p_order_id TEXT)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    new_balance := wallet_debit(uid, amt);
+    IF new_balance IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description, order_id)
+    VALUES (gen_random_uuid()::TEXT, uid, -amt, 'payment', 'Order payment - $' || to_char(amt, 'FM999999990.00'), p_order_id);
+
+    RETURN new_balance;
+END;
+$$;
+
+-- Debit the sender, record the transaction and create the gift; NULL when funds are short
+CREATE OR REPLACE FUNCTION send_gift_and_log(p_sender TEXT, p_recipient_email TEXT, p_amount NUMERIC, p_message TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+    new_gift_id TEXT;
+    new_gift_code TEXT;
+BEGIN
+    new_balance := wallet_debit(p_sender, p_amount);
+    IF new_balance IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description)
+    VALUES (gen_random_uuid()::TEXT, p_sender, -p_amount, 'gift_sent', 'Gift sent to ' || p_recipient_email);
+
+    INSERT INTO gifts (id, sender_id, recipient_email, amount, message, code, status)
+    VALUES (
+        gen_random_uuid()::TEXT,
+        p_sender,
+        p_recipient_email,
+        p_amount,
+        p_message,
+        'GIFT-' || upper(encode(gen_random_bytes(4), 'hex')),
+        'pending'
+    )
+    RETURNING id, code INTO new_gift_id, new_gift_code;
+
+    RETURN jsonb_build_object(
+        'gift_id', new_gift_id,
+        'gift_code', new_gift_code,
+        'new_balance', new_balance
+    );
+END;
+$$;
+
+-- Claim a pending gift and credit the recipient; NULL when the gift doesn't exist,
+-- {'status': ...} when it is no longer pending
+CREATE OR REPLACE FUNCTION redeem_gift_and_log(p_gift_id TEXT, p_user TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    gift_amount NUMERIC;
+    gift_status TEXT;
+    new_balance NUMERIC;
+BEGIN
+    UPDATE gifts
+    SET status = 'redeemed',
+        redeemed_by = p_user,
+        redeemed_at = NOW()
+    WHERE id = p_gift_id AND status = 'pending'
+    RETURNING amount INTO gift_amount;
+
+    IF gift_amount IS NULL THEN
+        SELECT status INTO gift_status FROM gifts WHERE id = p_gift_id;
+        IF gift_status IS NULL THEN
+            RETURN NULL;
+        END IF;
+        RETURN jsonb_build_object('status', gift_status);
+    END IF;
+
+    new_balance := wallet_credit(p_user, gift_amount);
+
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description)
+    VALUES (gen_random_uuid()::TEXT, p_user, gift_amount, 'gift_received', 'Gift card redeemed - $' || to_char(gift_amount, 'FM999999990.00'));
+
+    RETURN jsonb_build_object(
+        'status', 'redeemed',
+        'amount', gift_amount,
+        'new_balance', new_balance
+    );
+END;
+$$;
+
+-- Keep user_loyalty.balance in step with every loyalty transaction
+CREATE OR REPLACE FUNCTION apply_loyalty_transaction()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO user_loyalty (user_id, balance, updated_at)
+    VALUES (NEW.user_id, NEW.points_change, NOW())
+    ON CONFLICT (user_id) DO UPDATE
+    SET balance = user_loyalty.balance + EXCLUDED.balance,
+        updated_at = NOW();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS loyalty_transactions_apply_balance ON loyalty_transactions;
+CREATE TRIGGER loyalty_transactions_apply_balance
+AFTER INSERT ON loyalty_transactions
+FOR EACH ROW EXECUTE FUNCTION apply_loyalty_transaction();
+
+-- Backfill balances for users whose history predates the trigger
+INSERT INTO user_loyalty (user_id, balance)
+SELECT user_id, SUM(points_change)::INTEGER
+FROM loyalty_transactions
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
+
+-- Spend loyalty points on a reward voucher. The user's balance row is locked for
+-- the check, so concurrent redemptions queue instead of both passing it. Returns
+-- {'redeemed': false, 'points': balance} when the balance is short, otherwise
+-- {'redeemed': true, 'points': remaining balance}.
+CREATE OR REPLACE FUNCTION redeem_reward_and_log(
+    p_user TEXT,
+    p_reward_type TEXT,
+    p_cost INTEGER,
+    p_description TEXT,
+    p_code TEXT,
+    p_expires_at TIMESTAMPTZ
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    current_points INTEGER;
+BEGIN
+    SELECT balance INTO current_points FROM user_loyalty WHERE user_id = p_user FOR UPDATE;
+    current_points := COALESCE(current_points, 0);
+
+    IF current_points < p_cost THEN
+        RETURN jsonb_build_object('redeemed', false, 'points', current_points);
+    END IF;
+
+    -- The loyalty_transactions trigger deducts the points from user_loyalty
+    INSERT INTO loyalty_transactions (id, user_id, points_change, transaction_type, description)
+    VALUES (gen_random_uuid()::TEXT, p_user, -p_cost, 'redeem', p_description);
+
+    INSERT INTO reward_vouchers (id, user_id, reward_type, code, status, expires_at)
+    VALUES (gen_random_uuid()::TEXT, p_user, p_reward_type, p_code, 'active', p_expires_at);
+
+    RETURN jsonb_build_object('redeemed', true, 'points', current_points - p_cost);
+END;
+$$;
+
+-- Ranked shop search. Scores mirror the original Python ranking; trigram
+-- similarity on the name stands in for the old character-overlap typo check.
+CREATE OR REPLACE FUNCTION search_shops(q TEXT, max_results INTEGER DEFAULT 20)
+RETURNS SETOF JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH params AS (
+        SELECT lower(btrim(q)) AS term
+    ),
+    patterns AS (
+        SELECT term, '%' || replace(replace(replace(term, '!', '!!'), '%', '!%'), '_', '!_') || '%' AS pattern
+        FROM params
+    ),
+    matches AS (
+        SELECT s AS shop,
+            CASE
+                WHEN lower(s.name) = p.term THEN 100
+                WHEN starts_with(lower(s.name), p.term) THEN 80
+                WHEN strpos(' ' || lower(s.name), ' ' || p.term) > 0
+                  OR strpos(lower(s.name) || ' ', p.term || ' ') > 0 THEN 60
+                WHEN strpos(lower(s.name), p.term) > 0 THEN 40
+                ELSE 0
+            END
+            + CASE WHEN strpos(lower(COALESCE(s.description, '')), p.term) > 0 THEN 20 ELSE 0 END
+            + CASE WHEN strpos(lower(COALESCE(s.address, '')), p.term) > 0 THEN 10 ELSE 0 END AS score
+        FROM shops s, patterns p
+        WHERE p.term <> ''
+          AND s.is_active
+          AND (s.name ILIKE p.pattern ESCAPE '!'
+               OR s.description ILIKE p.pattern ESCAPE '!'
+               OR s.address ILIKE p.pattern ESCAPE '!'
+               OR s.name % p.term)
+    )
+    SELECT to_jsonb(shop) || jsonb_build_object('_score', CASE WHEN score = 0 THEN 15 ELSE score END)
+    FROM matches
+    ORDER BY CASE WHEN score = 0 THEN 15 ELSE score END DESC, (shop).name
+    LIMIT max_results;
+$$;
+
+-- Ranked menu item search across available items, with the shop name embedded
+CREATE OR REPLACE FUNCTION search_menu_items(q TEXT, max_results INTEGER DEFAULT 20)
+RETURNS SETOF JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH params AS (
+        SELECT lower(btrim(q)) AS term
+    ),
+    patterns AS (
+        SELECT term, '%' || replace(replace(replace(term, '!', '!!'), '%', '!%'), '_', '!_') || '%' AS pattern
+        FROM params
+    ),
+    matches AS (
+        SELECT m AS item, s.name AS shop_name,
+            CASE
+                WHEN lower(m.name) = p.term THEN 100
+                WHEN starts_with(lower(m.name), p.term) THEN 80
+                WHEN strpos(lower(m.name), p.term) > 0 THEN 50
+                ELSE 0
+            END
+            + CASE WHEN strpos(lower(COALESCE(m.description, '')), p.term) > 0 THEN 20 ELSE 0 END
+            + CASE WHEN strpos(lower(COALESCE(m.category, '')), p.term) > 0 THEN 30 ELSE 0 END AS score
+        FROM menu_items m
+        CROSS JOIN patterns p
+        LEFT JOIN shops s ON s.id = m.shop_id
+        WHERE p.term <> ''
+          AND m.is_available
+          AND (m.name ILIKE p.pattern ESCAPE '!'
+               OR m.description ILIKE p.pattern ESCAPE '!'
+               OR m.category ILIKE p.pattern ESCAPE '!')
+    )
+    SELECT to_jsonb(item) || jsonb_build_object(
+        'price', (item).base_price,
+        'shops', CASE WHEN shop_name IS NULL THEN NULL ELSE jsonb_build_object('name', shop_name) END,
+        '_score', score
+    )
+    FROM matches
+    ORDER BY score DESC, (item).name
+    LIMIT max_results;
+$$;
+
+-- Stamp updated_at on every row update so callers don't have to send it
+CREATE OR REPLACE FUNCTION set_updated_at()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS orders_set_updated_at ON orders;
+CREATE TRIGGER orders_set_updated_at
+BEFORE UPDATE ON orders
+FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+DROP TRIGGER IF EXISTS wallets_set_updated_at ON wallets;
+CREATE TRIGGER wallets_set_updated_at
+BEFORE UPDATE ON wallets
+FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+DROP TRIGGER IF EXISTS user_streaks_set_updated_at ON user_streaks;
+CREATE TRIGGER user_streaks_set_updated_at
+BEFORE UPDATE ON user_streaks
+FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+-- Replace the demo catalog with the given shops and menu items in one transaction.
+-- The TEXT-argument variant is dropped so PostgREST resolves a single function.
+DROP FUNCTION IF EXISTS seed_database(TEXT, TEXT);
+CREATE OR REPLACE FUNCTION seed_database(p_shops JSONB, p_items JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    shops_created INTEGER;
+    items_created INTEGER;
+BEGIN
+    DELETE FROM menu_items WHERE id IS NOT NULL;
+    DELETE FROM shops WHERE id IS NOT NULL;
+
+    INSERT INTO shops
+    SELECT * FROM jsonb_populate_recordset(NULL::shops, p_shops);
+    GET DIAGNOSTICS shops_created = ROW_COUNT;
+
+    -- Items without customization options omit the key; give them the column's empty default
+    INSERT INTO menu_items
+    SELECT m.*
+    FROM jsonb_array_elements(p_items) AS item,
+         jsonb_populate_record(NULL::menu_items, '{"customization_options": {}}'::JSONB || item) AS m;
+    GET DIAGNOSTICS items_created = ROW_COUNT;
+
+    RETURN jsonb_build_object(
+        'shops_created', shops_created,
+        'menu_items_created', items_created
+    );
+END;
+$$;
+
 -- Enable Row Level Security (RLS)
 -- ALTER TABLE shops ENABLE ROW LEVEL SECURITY;
 -- ALTER TABLE menu_items ENABLE ROW LEVEL SECURITY;
@@ -1,17 +1,33 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Response
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
-import base64
-import json
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+from postgrest.exceptions import APIError
+import asyncio
+import bisect
+import hashlib
+import httpx
 import os
+import re
+import secrets
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import product
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Literal, Optional, Dict, Any
 import uuid
+from types import MappingProxyType
 from datetime import datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+import orjson
+import pybase64
 import stripe
+from cachetools import TLRUCache, TTLCache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -23,23 +39,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+JWT_ROLE_CACHE_TTL_SECONDS = 30
+
+def _jwt_role_cache_expiry(_key, value, now):
+    """Expire cached roles after the TTL or at the token's own `exp`, whichever is first."""
+    _role, exp = value
+    expires_at = now + JWT_ROLE_CACHE_TTL_SECONDS
+    return min(expires_at, exp) if exp else expires_at
+
+# Keyed by a token hash so raw tokens are never retained in memory.
+_jwt_role_cache = TLRUCache(maxsize=10000, ttu=_jwt_role_cache_expiry, timer=time.time)
+
 def get_jwt_role(token: str) -> Optional[str]:
     """Decode JWT payload without verification to inspect the role claim."""
+    cache_key = hashlib.sha256(token.encode()).hexdigest()[:16]
+    cached = _jwt_role_cache.get(cache_key)
+    if cached is not None:
+        return cached[0]
+
     try:
         payload_b64 = token.split('.')[1]
         padding = '=' * (-len(payload_b64) % 4)
-        payload_json = base64.urlsafe_b64decode(payload_b64 + padding).decode('utf-8')
-        payload = json.loads(payload_json)
-        return payload.get('role')
+        payload = orjson.loads(pybase64.urlsafe_b64decode(payload_b64 + padding))
+        role = payload.get('role')
+        exp = payload.get('exp')
     except Exception:
+        # Invalid tokens are never cached so they are re-checked on every call.
         return None
 
+    exp = exp if isinstance(exp, (int, float)) else None
+    if exp is None or exp > time.time():
+        _jwt_role_cache[cache_key] = (role, exp)
+    return role
+
 # Supabase connection
 supabase_url = os.environ.get('SUPABASE_URL', '')
 supabase_service_role_key = os.environ.get('SUPABASE_SERVICE_ROLE_KEY', '')
 supabase_legacy_key = os.environ.get('SUPABASE_KEY', '')
 supabase_key = supabase_service_role_key or supabase_legacy_key
-supabase: Client = create_client(supabase_url, supabase_key)
+
+# Shared async client, created once in the app lifespan so every request reuses
+# the same pooled HTTP connections without blocking the event loop.
+supabase: AsyncClient
+# The keep-alive pool behind that client, also used directly for requests whose
+# body is already encoded (see /seed).
+http_client: httpx.AsyncClient
 
 if not supabase_service_role_key:
     logger.warning("SUPABASE_SERVICE_ROLE_KEY is not set. Falling back to SUPABASE_KEY.")
@@ -54,8 +98,52 @@ if supabase_key_role == 'anon':
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY', '')
 STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY', 'pk_test_51RglLGP6K8lIhnBJiqdFrOAZawOhieG39W2KhpAIk6uW2WHVsPteZDb8pfOrRZMWXhhdr0w1qnf869s66aA2BgbJ00OAEQMk0l')
 
+# Upper bound on threads running blocking SDK calls (e.g. Stripe) off the event loop.
+BLOCKING_IO_WORKERS = 32
+
+# Keep-alive connection pool shared by every Supabase request for the process lifetime.
+SUPABASE_MAX_CONNECTIONS = 50
+SUPABASE_MAX_KEEPALIVE_CONNECTIONS = 10
+SUPABASE_KEEPALIVE_EXPIRY_SECONDS = 300
+SUPABASE_REQUEST_TIMEOUT_SECONDS = 120
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supabase, http_client
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix='blocking-io')
+    )
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=SUPABASE_MAX_CONNECTIONS,
+            max_keepalive_connections=SUPABASE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=SUPABASE_REQUEST_TIMEOUT_SECONDS,
+    )
+    supabase = await acreate_client(
+        supabase_url,
+        supabase_key,
+        options=AsyncClientOptions(httpx_client=http_client),
+    )
+    search_trigrams_task = asyncio.create_task(keep_search_trigrams_fresh())
+    try:
+        yield
+    finally:
+        search_trigrams_task.cancel()
+        try:
+            await search_trigrams_task
+        except asyncio.CancelledError:
+            pass
+        await http_client.aclose()
+
 # Create the main app
-app = FastAPI(title="BeanHop API", version="1.0.0")
+app = FastAPI(
+    title="BeanHop API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -96,6 +184,8 @@ class OrderItem(BaseModel):
     quantity: int
     customizations: Dict[str, str] = {}
 
+OrderStatus = Literal["pending", "confirmed", "preparing", "ready", "completed", "cancelled"]
+
 class OrderCreate(BaseModel):
     user_id: str
     shop_id: str
@@ -109,23 +199,33 @@ class OrderCreate(BaseModel):
 
 # ============== Helper Functions ==============
 
+LOYALTY_LEVEL_THRESHOLDS = (0, 100, 500, 2000)
+LOYALTY_LEVELS = ("Bronze", "Silver", "Gold", "Platinum")
+
+@lru_cache(maxsize=4096)
 def calculate_loyalty_level(points: int) -> str:
-    if points >= 2000:
-        return "Platinum"
-    elif points >= 500:
-        return "Gold"
-    elif points >= 100:
-        return "Silver"
-    return "Bronze"
+    index = bisect.bisect_right(LOYALTY_LEVEL_THRESHOLDS, points) - 1
+    return LOYALTY_LEVELS[max(index, 0)]
 
-def generate_order_number() -> str:
-    return f"ORD-{uuid.uuid4().hex[:6].upper()}"
+def to_cents(dollars: float) -> int:
+    """Convert a dollar amount to integer cents, rounding half up."""
+    return int((Decimal(str(dollars)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
 
-def find_stripe_customer(user_id: str, email: Optional[str] = None):
-    """Find an existing Stripe customer for this app user."""
-    if not stripe.api_key:
-        return None
+def without_none(**values: Any) -> Dict[str, Any]:
+    """Build a dict from keyword arguments, dropping those that are None."""
+    return {key: value for key, value in values.items() if value is not None}
+
+def utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
 
+ORDER_NUMBER_ATTEMPTS = 3
+UNIQUE_VIOLATION = '23505'
+
+def generate_order_number() -> str:
+    return f"ORD-{secrets.token_hex(3).upper()}"
+
+def search_stripe_customer(user_id: str, email: Optional[str] = None):
+    """Search Stripe for a customer tagged with this app user id."""
     # Prefer metadata lookup by app user id.
     try:
         search_result = stripe.Customer.search(
@@ -146,28 +246,122 @@ def find_stripe_customer(user_id: str, email: Optional[str] = None):
                     return customer
         except Exception as e:
             logger.warning(f"Stripe customer email lookup failed: {e}")
-    else:
-        # Fallback for environments where Customer.search is unavailable.
-        try:
-            customers = stripe.Customer.list(limit=100)
-            for customer in customers.data:
-                metadata = customer.get('metadata') or {}
-                if metadata.get('user_id') == user_id:
-                    return customer
-        except Exception as e:
-            logger.warning(f"Stripe customer list fallback failed: {e}")
 
     return None
 
-def get_or_create_stripe_customer(user_id: str, email: Optional[str] = None):
-    """Get a Stripe customer for the user, creating one if missing."""
-    customer = find_stripe_customer(user_id, email=email)
+async def get_stored_stripe_customer_id(user_id: str) -> Optional[str]:
+    """Read the Stripe customer id persisted on the user's wallet row."""
+    response = await supabase.table('wallets').select('stripe_customer_id').eq('user_id', user_id).limit(1).execute()
+    if response.data:
+        return response.data[0].get('stripe_customer_id')
+    return None
+
+async def store_stripe_customer_id(user_id: str, customer_id: Optional[str]) -> None:
+    """Persist the user's Stripe customer id, creating an empty wallet row if needed."""
+    try:
+        response = await supabase.table('wallets').update({
+            'stripe_customer_id': customer_id,
+        }).eq('user_id', user_id).execute()
+
+        if not response.data and customer_id:
+            await supabase.table('wallets').insert({
+                'user_id': user_id,
+                'balance': 0.0,
+                'stripe_customer_id': customer_id
+            }).execute()
+    except Exception as e:
+        logger.warning(f"Failed to store Stripe customer id for user {user_id}: {e}")
+
+async def find_stripe_customer(user_id: str, email: Optional[str] = None):
+    """Find an existing Stripe customer for this app user."""
+    if not stripe.api_key:
+        return None
+
+    customer_id = await get_stored_stripe_customer_id(user_id)
+    if customer_id:
+        try:
+            customer = await asyncio.to_thread(stripe.Customer.retrieve, customer_id)
+            if not customer.get('deleted'):
+                return customer
+        except stripe.error.InvalidRequestError as e:
+            logger.warning(f"Stored Stripe customer {customer_id} could not be retrieved: {e}")
+
+    # Backfill users created before the customer id was stored on their wallet.
+    customer = await asyncio.to_thread(search_stripe_customer, user_id, email=email)
     if customer:
-        return customer
+        await store_stripe_customer_id(user_id, customer.id)
+    return customer
 
-    return stripe.Customer.create(
-        email=email,
-        metadata={"user_id": user_id}
+# Maps app user id -> Stripe customer id so repeat payments skip the customer lookup.
+_stripe_customer_cache = TTLCache(maxsize=50_000, ttl=3600)
+
+async def get_or_create_stripe_customer(user_id: str, email: Optional[str] = None):
+    """Get a Stripe customer for the user, creating one if missing."""
+    customer_id = _stripe_customer_cache.get(user_id) or await get_stored_stripe_customer_id(user_id)
+    if customer_id:
+        _stripe_customer_cache[user_id] = customer_id
+        return stripe.Customer.construct_from({"id": customer_id}, stripe.api_key)
+
+    customer = await asyncio.to_thread(search_stripe_customer, user_id, email=email)
+    if not customer:
+        customer = await asyncio.to_thread(
+            stripe.Customer.create,
+            email=email,
+            metadata={"user_id": user_id}
+        )
+
+    await store_stripe_customer_id(user_id, customer.id)
+    _stripe_customer_cache[user_id] = customer.id
+    return customer
+
+async def forget_stripe_customer(user_id: Optional[str], error: Exception) -> None:
+    """Drop a stored customer id once Stripe reports the customer no longer exists."""
+    if user_id and isinstance(error, stripe.error.InvalidRequestError) and error.code == 'resource_missing':
+        _stripe_customer_cache.pop(user_id, None)
+        await store_stripe_customer_id(user_id, None)
+
+# Maps payment method id -> owning customer id so back-to-back requests in one
+# checkout skip the retrieve. Kept short because cards can be detached or moved
+# outside this process (dashboard, webhooks, other workers); charges always
+# re-verify against Stripe.
+PAYMENT_METHOD_OWNER_TTL_SECONDS = 30
+_payment_method_owner_cache = TTLCache(maxsize=50_000, ttl=PAYMENT_METHOD_OWNER_TTL_SECONDS)
+
+# Expanded on retrieve so the default-card check needs no follow-up requests.
+PAYMENT_INTENT_EXPAND = ['customer', 'payment_method']
+
+async def verify_payment_method_owner(payment_method_id: str, customer_id: str, use_cache: bool = True) -> None:
+    """Reject payment methods that are not attached to the given customer."""
+    owner_id = _payment_method_owner_cache.get(payment_method_id) if use_cache else None
+    if owner_id is None:
+        payment_method = await asyncio.to_thread(stripe.PaymentMethod.retrieve, payment_method_id)
+        owner_id = payment_method.customer
+        if owner_id:
+            _payment_method_owner_cache[payment_method_id] = owner_id
+        else:
+            _payment_method_owner_cache.pop(payment_method_id, None)
+
+    if owner_id != customer_id:
+        raise HTTPException(status_code=400, detail="Selected payment method does not belong to user")
+
+async def ensure_default_payment_method(customer, payment_method_id: str) -> None:
+    """Set the customer's default payment method.
+
+    The Stripe call is skipped only when a fully retrieved customer already
+    has this default; bare ids and stubs are always updated.
+    """
+    if isinstance(customer, str):
+        customer_id, invoice_settings = customer, None
+    else:
+        customer_id, invoice_settings = customer.id, customer.get('invoice_settings')
+
+    if invoice_settings is not None and invoice_settings.get('default_payment_method') == payment_method_id:
+        return
+
+    await asyncio.to_thread(
+        stripe.Customer.modify,
+        customer_id,
+        invoice_settings={"default_payment_method": payment_method_id}
     )
 
 # ============== API Routes ==============
@@ -178,30 +372,68 @@ async def root():
 
 @api_router.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    # ORJSONResponse serializes datetimes natively, no isoformat() round trip needed
+    return {"status": "healthy", "timestamp": datetime.now(timezone.utc)}
 
 # ------------ Shops ------------
 
+# Shop and menu data changes rarely, so reads are served from a short-lived
+# in-process cache and marked cacheable for browsers/CDNs for the same window.
+CATALOG_CACHE_TTL_SECONDS = 60
+CATALOG_CACHE_CONTROL = f"public, max-age={CATALOG_CACHE_TTL_SECONDS}, s-maxage={CATALOG_CACHE_TTL_SECONDS}"
+_catalog_cache = TTLCache(maxsize=1024, ttl=CATALOG_CACHE_TTL_SECONDS)
+
+# Column projections for read endpoints; list views skip fields only the
+# detail screens render (contact details, full order items).
+SHOP_LIST_COLUMNS = 'id,name,description,logo_url,banner_url,address,city,latitude,longitude,hours,is_active,rating,rating_count,loyalty_multiplier'
+SHOP_COLUMNS = f'{SHOP_LIST_COLUMNS},phone,email'
+MENU_ITEM_COLUMNS = 'id,shop_id,name,description,category,base_price,image_url,customization_options,is_available,is_featured,sort_order'
+ORDER_LIST_COLUMNS = 'id,order_number,user_id,shop_id,shop_name,status,subtotal,tax,discount,total,pickup_time,points_earned,created_at,updated_at'
+ORDER_COLUMNS = f'{ORDER_LIST_COLUMNS},items,special_instructions,stripe_payment_id'
+LOYALTY_TRANSACTION_COLUMNS = 'id,shop_id,order_id,points_change,transaction_type,description,created_at'
+GIFT_COLUMNS = 'id,sender_id,recipient_email,amount,message,code,status,created_at'
+VOUCHER_COLUMNS = 'id,reward_type,code,status,expires_at,created_at'
+
+def invalidate_catalog_cache() -> None:
+    global _search_trigrams
+    _catalog_cache.clear()
+    # New catalog text may not be in the trigram set yet; stop filtering on it
+    # and have the background task rebuild it now.
+    _search_trigrams = None
+    _search_trigrams_stale.set()
+
 @api_router.get("/shops")
-async def get_shops(city: Optional[str] = None, is_active: bool = True):
+async def get_shops(response: Response, city: Optional[str] = None, is_active: bool = True):
     """Get all shops, optionally filtered by city"""
     try:
-        query = supabase.table('shops').select('*').eq('is_active', is_active)
+        response.headers['Cache-Control'] = CATALOG_CACHE_CONTROL
+        cache_key = ('shops', city, is_active)
+        if cache_key in _catalog_cache:
+            return _catalog_cache[cache_key]
+
+        query = supabase.table('shops').select(SHOP_LIST_COLUMNS).eq('is_active', is_active)
         if city:
             query = query.eq('city', city)
         
-        response = query.execute()
-        return response.data
+        shops_response = await query.execute()
+        _catalog_cache[cache_key] = shops_response.data
+        return shops_response.data
     except Exception as e:
         logger.error(f"Error fetching shops: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/shops/{shop_id}")
-async def get_shop(shop_id: str):
+async def get_shop(response: Response, shop_id: str):
     """Get a single shop by ID"""
     try:
-        response = supabase.table('shops').select('*').eq('id', shop_id).single().execute()
-        return response.data
+        response.headers['Cache-Control'] = CATALOG_CACHE_CONTROL
+        cache_key = ('shop', shop_id)
+        if cache_key in _catalog_cache:
+            return _catalog_cache[cache_key]
+
+        shop_response = await supabase.table('shops').select(SHOP_COLUMNS).eq('id', shop_id).single().execute()
+        _catalog_cache[cache_key] = shop_response.data
+        return shop_response.data
     except Exception as e:
         logger.error(f"Error fetching shop: {e}")
         raise HTTPException(status_code=404, detail="Shop not found")
@@ -210,26 +442,31 @@ async def get_shop(shop_id: str):
 async def create_shop(shop_data: ShopCreate):
     """Create a new shop"""
     try:
-        shop_dict = shop_data.dict()
-        shop_dict['id'] = str(uuid.uuid4())
-        shop_dict['created_at'] = datetime.utcnow().isoformat()
+        shop_dict = shop_data.model_dump()
         
-        response = supabase.table('shops').insert(shop_dict).execute()
+        response = await supabase.table('shops').insert(shop_dict).execute()
+        invalidate_catalog_cache()
         return response.data[0]
     except Exception as e:
         logger.error(f"Error creating shop: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/shops/{shop_id}/menu")
-async def get_shop_menu(shop_id: str, category: Optional[str] = None):
+async def get_shop_menu(response: Response, shop_id: str, category: Optional[str] = None):
     """Get menu items for a shop"""
     try:
-        query = supabase.table('menu_items').select('*').eq('shop_id', shop_id).eq('is_available', True)
+        response.headers['Cache-Control'] = CATALOG_CACHE_CONTROL
+        cache_key = ('menu', shop_id, category)
+        if cache_key in _catalog_cache:
+            return _catalog_cache[cache_key]
+
+        query = supabase.table('menu_items').select(MENU_ITEM_COLUMNS).eq('shop_id', shop_id).eq('is_available', True)
         if category:
             query = query.eq('category', category)
         
-        response = query.order('sort_order').execute()
-        return response.data
+        menu_response = await query.order('sort_order').execute()
+        _catalog_cache[cache_key] = menu_response.data
+        return menu_response.data
     except Exception as e:
         logger.error(f"Error fetching menu: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -240,7 +477,7 @@ async def get_shop_menu(shop_id: str, category: Optional[str] = None):
 async def get_menu_item(item_id: str):
     """Get a single menu item by ID"""
     try:
-        response = supabase.table('menu_items').select('*').eq('id', item_id).single().execute()
+        response = await supabase.table('menu_items').select(MENU_ITEM_COLUMNS).eq('id', item_id).single().execute()
         return response.data
     except Exception as e:
         logger.error(f"Error fetching menu item: {e}")
@@ -250,11 +487,11 @@ async def get_menu_item(item_id: str):
 async def create_menu_item(item_data: MenuItemCreate):
     """Create a new menu item"""
     try:
-        item_dict = item_data.dict()
-        item_dict['id'] = str(uuid.uuid4())
-        item_dict['created_at'] = datetime.utcnow().isoformat()
+        # Omit unset fields so column defaults (e.g. empty customization_options) apply
+        item_dict = item_data.model_dump(exclude_none=True)
         
-        response = supabase.table('menu_items').insert(item_dict).execute()
+        response = await supabase.table('menu_items').insert(item_dict).execute()
+        invalidate_catalog_cache()
         return response.data[0]
     except Exception as e:
         logger.error(f"Error creating menu item: {e}")
@@ -301,48 +538,40 @@ async def create_payment_intent(request: PaymentIntentRequest):
             raise HTTPException(status_code=400, detail="Amount must be greater than 0")
 
         # Convert dollars to cents
-        amount_cents = int(round(request.amount * 100))
+        amount_cents = to_cents(request.amount)
         
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
         
-        metadata = {
-            "purpose": request.purpose,
-        }
-        if request.order_id:
-            metadata["order_id"] = request.order_id
+        customer_id = None
+        preferred_payment_method_id = None
         if request.user_id:
-            metadata["user_id"] = request.user_id
+            customer = await get_or_create_stripe_customer(request.user_id, email=request.email)
+            customer_id = customer.id
+
+            if request.preferred_payment_method_id:
+                await verify_payment_method_owner(request.preferred_payment_method_id, customer_id)
+                await ensure_default_payment_method(customer, request.preferred_payment_method_id)
+                preferred_payment_method_id = request.preferred_payment_method_id
 
         payment_intent_params: Dict[str, Any] = {
             "amount": amount_cents,
             "currency": "cad",
             "automatic_payment_methods": {"enabled": True},
-            "metadata": metadata,
+            "metadata": without_none(
+                purpose=request.purpose,
+                order_id=request.order_id,
+                user_id=request.user_id,
+                preferred_payment_method_id=preferred_payment_method_id,
+            ),
+            **without_none(
+                customer=customer_id,
+                setup_future_usage="off_session" if customer_id and request.save_payment_method else None,
+            ),
         }
 
-        customer_id = None
-        if request.user_id:
-            customer = get_or_create_stripe_customer(request.user_id, email=request.email)
-            customer_id = customer.id
-            payment_intent_params["customer"] = customer_id
-
-            if request.preferred_payment_method_id:
-                payment_method = stripe.PaymentMethod.retrieve(request.preferred_payment_method_id)
-                if payment_method.customer != customer_id:
-                    raise HTTPException(status_code=400, detail="Selected payment method does not belong to user")
-
-                stripe.Customer.modify(
-                    customer_id,
-                    invoice_settings={"default_payment_method": request.preferred_payment_method_id}
-                )
-                metadata["preferred_payment_method_id"] = request.preferred_payment_method_id
-
-            if request.save_payment_method:
-                payment_intent_params["setup_future_usage"] = "off_session"
-
         # Create real payment intent
-        payment_intent = stripe.PaymentIntent.create(**payment_intent_params)
+        payment_intent = await asyncio.to_thread(stripe.PaymentIntent.create, **payment_intent_params)
         
         return {
             "clientSecret": payment_intent.client_secret,
@@ -352,6 +581,7 @@ async def create_payment_intent(request: PaymentIntentRequest):
             "customerId": customer_id,
         }
     except stripe.error.StripeError as e:
+        await forget_stripe_customer(request.user_id, e)
         logger.error(f"Stripe error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -363,7 +593,7 @@ async def confirm_payment(payment_intent_id: str, order_id: str):
     """Confirm payment was successful and update order"""
     try:
         if stripe.api_key:
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+            payment_intent = await asyncio.to_thread(stripe.PaymentIntent.retrieve, payment_intent_id, expand=PAYMENT_INTENT_EXPAND)
             if payment_intent.status != 'succeeded':
                 raise HTTPException(status_code=400, detail="Payment is not completed")
 
@@ -372,16 +602,12 @@ async def confirm_payment(payment_intent_id: str, order_id: str):
                 raise HTTPException(status_code=400, detail="Payment intent does not match order")
 
             if payment_intent.customer and payment_intent.payment_method:
-                stripe.Customer.modify(
-                    payment_intent.customer,
-                    invoice_settings={"default_payment_method": payment_intent.payment_method}
-                )
+                await ensure_default_payment_method(payment_intent.customer, payment_intent.payment_method.id)
 
         # Update order with payment info and status
-        response = supabase.table('orders').update({
+        response = await supabase.table('orders').update({
             'stripe_payment_id': payment_intent_id,
-            'status': 'confirmed',
-            'updated_at': datetime.utcnow().isoformat()
+            'status': 'confirmed'
         }).eq('id', order_id).execute()
         
         if not response.data:
@@ -401,13 +627,14 @@ async def get_saved_payment_methods(user_id: str, email: Optional[str] = None):
         if not stripe.api_key:
             return {"customer_id": None, "payment_methods": []}
 
-        customer = find_stripe_customer(user_id, email=email)
+        customer = await find_stripe_customer(user_id, email=email)
         if not customer:
             return {"customer_id": None, "payment_methods": []}
 
         customer_id = customer.id
         default_payment_method_id = (customer.get('invoice_settings') or {}).get('default_payment_method')
-        payment_methods = stripe.PaymentMethod.list(
+        payment_methods = await asyncio.to_thread(
+            stripe.PaymentMethod.list,
             customer=customer_id,
             type='card',
             limit=20
@@ -443,8 +670,9 @@ async def create_payment_method_setup_intent(request: PaymentMethodSetupRequest)
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
 
-        customer = get_or_create_stripe_customer(request.user_id, email=request.email)
-        setup_intent = stripe.SetupIntent.create(
+        customer = await get_or_create_stripe_customer(request.user_id, email=request.email)
+        setup_intent = await asyncio.to_thread(
+            stripe.SetupIntent.create,
             customer=customer.id,
             automatic_payment_methods={"enabled": True},
             usage="off_session",
@@ -457,6 +685,7 @@ async def create_payment_method_setup_intent(request: PaymentMethodSetupRequest)
             "customerId": customer.id,
         }
     except stripe.error.StripeError as e:
+        await forget_stripe_customer(request.user_id, e)
         logger.error(f"Stripe error creating setup intent: {e}")
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -470,19 +699,12 @@ async def set_default_payment_method(request: SetDefaultPaymentMethodRequest):
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
 
-        customer = find_stripe_customer(request.user_id, email=request.email)
+        customer = await find_stripe_customer(request.user_id, email=request.email)
         if not customer:
             raise HTTPException(status_code=404, detail="Stripe customer not found")
 
-        customer_id = customer.id
-        payment_method = stripe.PaymentMethod.retrieve(request.payment_method_id)
-        if payment_method.customer != customer_id:
-            raise HTTPException(status_code=400, detail="Selected payment method does not belong to user")
-
-        stripe.Customer.modify(
-            customer_id,
-            invoice_settings={"default_payment_method": request.payment_method_id}
-        )
+        await verify_payment_method_owner(request.payment_method_id, customer.id)
+        await ensure_default_payment_method(customer, request.payment_method_id)
 
         return {
             "success": True,
@@ -508,38 +730,36 @@ async def delete_saved_payment_method(
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
 
-        customer = find_stripe_customer(user_id, email=email)
+        customer = await find_stripe_customer(user_id, email=email)
         if not customer:
             raise HTTPException(status_code=404, detail="Stripe customer not found")
 
         customer_id = customer.id
-        payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
-        if payment_method.customer != customer_id:
-            raise HTTPException(status_code=400, detail="Selected payment method does not belong to user")
+        await verify_payment_method_owner(payment_method_id, customer_id)
 
         default_payment_method_id = (customer.get('invoice_settings') or {}).get('default_payment_method')
         if default_payment_method_id == payment_method_id:
-            stripe.Customer.modify(
+            await asyncio.to_thread(
+                stripe.Customer.modify,
                 customer_id,
                 invoice_settings={"default_payment_method": None}
             )
 
-        stripe.PaymentMethod.detach(payment_method_id)
+        await asyncio.to_thread(stripe.PaymentMethod.detach, payment_method_id)
+        _payment_method_owner_cache.pop(payment_method_id, None)
 
         # If the default card was removed, promote another saved card (if one exists).
         replacement_default_id = None
         if default_payment_method_id == payment_method_id:
-            remaining_cards = stripe.PaymentMethod.list(
+            remaining_cards = await asyncio.to_thread(
+                stripe.PaymentMethod.list,
                 customer=customer_id,
                 type='card',
                 limit=1
             )
             if remaining_cards.data:
                 replacement_default_id = remaining_cards.data[0].id
-                stripe.Customer.modify(
-                    customer_id,
-                    invoice_settings={"default_payment_method": replacement_default_id}
-                )
+                await ensure_default_payment_method(customer_id, replacement_default_id)
 
         return {
             "success": True,
@@ -565,36 +785,29 @@ async def pay_with_saved_method(request: SavedPaymentChargeRequest):
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
 
-        amount_cents = int(round(request.amount * 100))
+        amount_cents = to_cents(request.amount)
         if amount_cents <= 0:
             raise HTTPException(status_code=400, detail="Invalid amount")
 
-        customer = get_or_create_stripe_customer(request.user_id, email=request.email)
-        payment_method = stripe.PaymentMethod.retrieve(request.payment_method_id)
-        if payment_method.customer != customer.id:
-            raise HTTPException(status_code=400, detail="Selected payment method does not belong to user")
-
-        stripe.Customer.modify(
-            customer.id,
-            invoice_settings={"default_payment_method": request.payment_method_id}
-        )
-
-        metadata = {
-            "purpose": request.purpose,
-            "user_id": request.user_id,
-            "payment_method_id": request.payment_method_id,
-        }
-        if request.order_id:
-            metadata["order_id"] = request.order_id
+        customer = await get_or_create_stripe_customer(request.user_id, email=request.email)
+        # Money moves on this path, so check ownership against Stripe itself
+        await verify_payment_method_owner(request.payment_method_id, customer.id, use_cache=False)
+        await ensure_default_payment_method(customer, request.payment_method_id)
 
-        payment_intent = stripe.PaymentIntent.create(
+        payment_intent = await asyncio.to_thread(
+            stripe.PaymentIntent.create,
             amount=amount_cents,
             currency="cad",
             customer=customer.id,
             payment_method=request.payment_method_id,
             confirm=True,
             off_session=True,
-            metadata=metadata,
+            metadata=without_none(
+                purpose=request.purpose,
+                user_id=request.user_id,
+                payment_method_id=request.payment_method_id,
+                order_id=request.order_id,
+            ),
         )
 
         if payment_intent.status != "succeeded":
@@ -613,6 +826,7 @@ async def pay_with_saved_method(request: SavedPaymentChargeRequest):
         logger.error(f"Card error charging saved method: {e}")
         raise HTTPException(status_code=402, detail=getattr(e, "user_message", str(e)))
     except stripe.error.StripeError as e:
+        await forget_stripe_customer(request.user_id, e)
         logger.error(f"Stripe error charging saved method: {e}")
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -622,16 +836,18 @@ async def pay_with_saved_method(request: SavedPaymentChargeRequest):
 # ------------ Orders ------------
 
 @api_router.get("/orders")
-async def get_orders(user_id: Optional[str] = None, status: Optional[str] = None):
-    """Get orders, optionally filtered by user or status"""
+async def get_orders(user_id: Optional[str] = None, status: Optional[str] = None, limit: int = 50, offset: int = 0):
+    """Get a page of orders, newest first, optionally filtered by user or status"""
     try:
-        query = supabase.table('orders').select('*')
+        limit = min(max(limit, 1), 100)
+        offset = max(offset, 0)
+        query = supabase.table('orders').select(ORDER_LIST_COLUMNS)
         if user_id:
             query = query.eq('user_id', user_id)
         if status:
             query = query.eq('status', status)
         
-        response = query.order('created_at', desc=True).execute()
+        response = await query.order('created_at', desc=True).range(offset, offset + limit - 1).execute()
         return response.data
     except Exception as e:
         logger.error(f"Error fetching orders: {e}")
@@ -641,7 +857,7 @@ async def get_orders(user_id: Optional[str] = None, status: Optional[str] = None
 async def get_order(order_id: str):
     """Get a single order by ID"""
     try:
-        response = supabase.table('orders').select('*').eq('id', order_id).single().execute()
+        response = await supabase.table('orders').select(ORDER_COLUMNS).eq('id', order_id).single().execute()
         return response.data
     except Exception as e:
         logger.error(f"Error fetching order: {e}")
@@ -651,58 +867,34 @@ async def get_order(order_id: str):
 async def create_order(order_data: OrderCreate):
     """Create a new order"""
     try:
-        # Get shop name
-        shop_response = supabase.table('shops').select('name').eq('id', order_data.shop_id).single().execute()
-        shop_name = shop_response.data.get('name', 'Unknown Shop') if shop_response.data else 'Unknown Shop'
-        
         # Calculate points earned (1 point per dollar)
         points_earned = int(order_data.subtotal)
         
-        order_dict = order_data.dict()
-        order_dict['id'] = str(uuid.uuid4())
-        order_dict['order_number'] = generate_order_number()
-        order_dict['shop_name'] = shop_name
-        order_dict['status'] = 'pending'
+        order_dict = order_data.model_dump()
         order_dict['points_earned'] = points_earned
-        order_dict['discount'] = order_data.discount
-        order_dict['created_at'] = datetime.utcnow().isoformat()
-        order_dict['updated_at'] = datetime.utcnow().isoformat()
         
-        # Convert items to JSON-serializable format
-        order_dict['items'] = [item.dict() for item in order_data.items]
+        # Shop name lookup, order insert and loyalty earn happen atomically in one call.
+        # Order numbers only have 16M values, so retry on a unique-constraint collision.
+        for attempt in range(ORDER_NUMBER_ATTEMPTS):
+            order_dict['order_number'] = generate_order_number()
+            try:
+                response = await supabase.rpc('place_order', {'p_order': order_dict}).execute()
+                break
+            except APIError as e:
+                if e.code != UNIQUE_VIOLATION or attempt == ORDER_NUMBER_ATTEMPTS - 1:
+                    raise
         
-        response = supabase.table('orders').insert(order_dict).execute()
-        
-        # Create loyalty transaction
-        if points_earned > 0:
-            loyalty_tx = {
-                'id': str(uuid.uuid4()),
-                'user_id': order_data.user_id,
-                'shop_id': order_data.shop_id,
-                'order_id': order_dict['id'],
-                'points_change': points_earned,
-                'transaction_type': 'earn',
-                'description': f"Order #{order_dict['order_number']}",
-                'created_at': datetime.utcnow().isoformat()
-            }
-            supabase.table('loyalty_transactions').insert(loyalty_tx).execute()
-        
-        return response.data[0]
+        return response.data
     except Exception as e:
         logger.error(f"Error creating order: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.patch("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status: str):
+async def update_order_status(order_id: str, status: OrderStatus):
     """Update order status"""
-    valid_statuses = ["pending", "confirmed", "preparing", "ready", "completed", "cancelled"]
-    if status not in valid_statuses:
-        raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {valid_statuses}")
-    
     try:
-        response = supabase.table('orders').update({
-            'status': status,
-            'updated_at': datetime.utcnow().isoformat()
+        response = await supabase.table('orders').update({
+            'status': status
         }).eq('id', order_id).execute()
         
         if not response.data:
@@ -719,9 +911,8 @@ async def update_order_status(order_id: str, status: str):
 async def get_user_points(user_id: str):
     """Get total points for a user"""
     try:
-        response = supabase.table('loyalty_transactions').select('points_change').eq('user_id', user_id).execute()
-        
-        total_points = sum(tx['points_change'] for tx in response.data) if response.data else 0
+        response = await supabase.rpc('user_points', {'uid': user_id}).execute()
+        total_points = response.data or 0
         
         return {
             "user_id": user_id,
@@ -736,7 +927,7 @@ async def get_user_points(user_id: str):
 async def get_loyalty_transactions(user_id: str, limit: int = 50):
     """Get loyalty transaction history for a user"""
     try:
-        response = supabase.table('loyalty_transactions').select('*').eq('user_id', user_id).order('created_at', desc=True).limit(limit).execute()
+        response = await supabase.table('loyalty_transactions').select(LOYALTY_TRANSACTION_COLUMNS).eq('user_id', user_id).order('created_at', desc=True).limit(limit).execute()
         return response.data
     except Exception as e:
         logger.error(f"Error fetching loyalty transactions: {e}")
@@ -777,15 +968,38 @@ REWARD_DISCOUNT_VALUES = {
     'free_pastry': 3.50,
 }
 
+REWARD_COSTS = MappingProxyType({
+    'free_drink': 500,
+    'size_upgrade': 100,
+    'free_pastry': 300,
+})
+
+REWARD_DESCRIPTIONS = MappingProxyType({
+    'free_drink': 'Redeemed: Free Drink',
+    'size_upgrade': 'Redeemed: Size Upgrade',
+    'free_pastry': 'Redeemed: Free Pastry',
+})
+
+@lru_cache(maxsize=2)
+def _voucher_expiry(hour_bucket: int) -> str:
+    """Start of next month (UTC) as of the given hour since the epoch."""
+    now = datetime.fromtimestamp(hour_bucket * 3600, timezone.utc)
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return (month_start + timedelta(days=32)).replace(day=1).isoformat()
+
+def voucher_expiry() -> str:
+    return _voucher_expiry(int(time.time()) // 3600)
+
 def parse_iso_datetime(value: Optional[str]) -> Optional[datetime]:
     if not value:
         return None
 
     try:
         parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
-        if parsed.tzinfo:
-            return parsed.astimezone(timezone.utc).replace(tzinfo=None)
-        return parsed
+        # Timestamps without an offset are stored as UTC
+        if parsed.tzinfo is None:
+            return parsed.replace(tzinfo=timezone.utc)
+        return parsed.astimezone(timezone.utc)
     except Exception:
         return None
 
@@ -793,29 +1007,13 @@ def parse_iso_datetime(value: Optional[str]) -> Optional[datetime]:
 async def get_wallet(user_id: str):
     """Get user's wallet balance and transaction history"""
     try:
-        # Get wallet balance
-        wallet_response = supabase.table('wallets').select('*').eq('user_id', user_id).execute()
-        
-        if not wallet_response.data:
-            # Create wallet if doesn't exist
-            new_wallet = {
-                'id': str(uuid.uuid4()),
-                'user_id': user_id,
-                'balance': 0.0,
-                'created_at': datetime.utcnow().isoformat(),
-                'updated_at': datetime.utcnow().isoformat()
-            }
-            supabase.table('wallets').insert(new_wallet).execute()
-            wallet = new_wallet
-        else:
-            wallet = wallet_response.data[0]
-        
-        # Get recent transactions
-        tx_response = supabase.table('wallet_transactions').select('*').eq('user_id', user_id).order('created_at', desc=True).limit(20).execute()
+        # Creates the wallet if it doesn't exist and returns recent transactions in one call
+        response = await supabase.rpc('get_wallet_with_tx', {'uid': user_id}).execute()
+        wallet = response.data or {}
         
         return {
             "balance": wallet.get('balance', 0.0),
-            "transactions": tx_response.data if tx_response.data else []
+            "transactions": wallet.get('transactions') or []
         }
     except Exception as e:
         logger.error(f"Error fetching wallet: {e}")
@@ -831,13 +1029,14 @@ async def create_wallet_topup_payment_intent(request: WalletTopUpIntentRequest):
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
 
-        amount_cents = int(round(request.amount * 100))
+        amount_cents = to_cents(request.amount)
         if amount_cents <= 0:
             raise HTTPException(status_code=400, detail="Invalid top-up amount")
 
-        customer = get_or_create_stripe_customer(request.user_id, email=request.email)
+        customer = await get_or_create_stripe_customer(request.user_id, email=request.email)
 
-        payment_intent = stripe.PaymentIntent.create(
+        payment_intent = await asyncio.to_thread(
+            stripe.PaymentIntent.create,
             amount=amount_cents,
             currency="cad",
             automatic_payment_methods={"enabled": True},
@@ -860,6 +1059,7 @@ async def create_wallet_topup_payment_intent(request: WalletTopUpIntentRequest):
     except HTTPException:
         raise
     except stripe.error.StripeError as e:
+        await forget_stripe_customer(request.user_id, e)
         logger.error(f"Stripe error creating wallet top-up intent: {e}")
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -876,18 +1076,8 @@ async def topup_wallet(request: WalletTopUpRequest):
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Stripe is not configured on the server")
 
-        # Ensure this payment intent hasn't already been applied to wallet
-        existing_tx = (
-            supabase.table('wallet_transactions')
-            .select('id')
-            .eq('payment_intent_id', request.payment_intent_id)
-            .limit(1)
-            .execute()
-        )
-        if existing_tx.data:
-            raise HTTPException(status_code=409, detail="This payment has already been applied")
+        payment_intent = await asyncio.to_thread(stripe.PaymentIntent.retrieve, request.payment_intent_id, expand=PAYMENT_INTENT_EXPAND)
 
-        payment_intent = stripe.PaymentIntent.retrieve(request.payment_intent_id)
         if payment_intent.status != 'succeeded':
             raise HTTPException(status_code=400, detail="Payment is not completed")
 
@@ -899,7 +1089,7 @@ async def topup_wallet(request: WalletTopUpRequest):
         if metadata_purpose != 'wallet_topup' or metadata_user_id != request.user_id:
             raise HTTPException(status_code=400, detail="Payment intent does not match this wallet top-up")
 
-        expected_cents = int(round(request.amount * 100))
+        expected_cents = to_cents(request.amount)
         received_cents = int(payment_intent.amount_received or payment_intent.amount or 0)
         if received_cents != expected_cents:
             raise HTTPException(status_code=400, detail="Payment amount mismatch")
@@ -907,48 +1097,22 @@ async def topup_wallet(request: WalletTopUpRequest):
         topup_amount = received_cents / 100.0
 
         if payment_intent.customer and payment_intent.payment_method:
-            stripe.Customer.modify(
-                payment_intent.customer,
-                invoice_settings={"default_payment_method": payment_intent.payment_method}
-            )
+            await ensure_default_payment_method(payment_intent.customer, payment_intent.payment_method.id)
 
-        # Get or create wallet
-        wallet_response = supabase.table('wallets').select('*').eq('user_id', request.user_id).execute()
-        
-        if not wallet_response.data:
-            new_wallet = {
-                'id': str(uuid.uuid4()),
-                'user_id': request.user_id,
-                'balance': topup_amount,
-                'created_at': datetime.utcnow().isoformat(),
-                'updated_at': datetime.utcnow().isoformat()
-            }
-            supabase.table('wallets').insert(new_wallet).execute()
-            new_balance = topup_amount
-        else:
-            wallet = wallet_response.data[0]
-            new_balance = wallet['balance'] + topup_amount
-            supabase.table('wallets').update({
-                'balance': new_balance,
-                'updated_at': datetime.utcnow().isoformat()
-            }).eq('user_id', request.user_id).execute()
-        
-        # Create transaction record
-        tx = {
-            'id': str(uuid.uuid4()),
-            'user_id': request.user_id,
-            'amount': topup_amount,
-            'type': 'topup',
-            'description': f'Added ${topup_amount:.2f} to wallet',
-            'payment_intent_id': request.payment_intent_id,
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('wallet_transactions').insert(tx).execute()
+        # Credit the wallet and record the transaction in one database round trip.
+        # The RPC is idempotent on payment_intent_id, so retries never double-credit.
+        topup_response = await supabase.rpc('topup_and_log', {
+            'p_user': request.user_id,
+            'p_amount': topup_amount,
+            'p_pi': request.payment_intent_id
+        }).execute()
+        topup = topup_response.data[0]
         
         return {
             "success": True,
-            "new_balance": new_balance,
-            "transaction_id": tx['id'],
+            "new_balance": topup['new_balance'],
+            "transaction_id": topup['tx_id'],
+            "already_applied": not topup['applied'],
             "payment_intent_id": request.payment_intent_id
         }
     except HTTPException:
@@ -964,33 +1128,19 @@ async def topup_wallet(request: WalletTopUpRequest):
 async def pay_with_wallet(user_id: str, amount: float, order_id: Optional[str] = None):
     """Pay for an order using wallet balance"""
     try:
-        wallet_response = supabase.table('wallets').select('*').eq('user_id', user_id).execute()
-        
-        if not wallet_response.data:
-            raise HTTPException(status_code=400, detail="Wallet not found")
-        
-        wallet = wallet_response.data[0]
-        if wallet['balance'] < amount:
+        if amount <= 0:
+            raise HTTPException(status_code=400, detail="Amount must be greater than 0")
+
+        # Debit the wallet and log the payment in one transaction
+        payment_response = await supabase.rpc('pay_and_log', {
+            'uid': user_id,
+            'amt': amount,
+            'p_order_id': order_id
+        }).execute()
+        new_balance = payment_response.data
+        if new_balance is None:
             raise HTTPException(status_code=400, detail="Insufficient wallet balance")
         
-        new_balance = wallet['balance'] - amount
-        supabase.table('wallets').update({
-            'balance': new_balance,
-            'updated_at': datetime.utcnow().isoformat()
-        }).eq('user_id', user_id).execute()
-        
-        # Create transaction record
-        tx = {
-            'id': str(uuid.uuid4()),
-            'user_id': user_id,
-            'amount': -amount,
-            'type': 'payment',
-            'description': f'Order payment - ${amount:.2f}',
-            'order_id': order_id,
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('wallet_transactions').insert(tx).execute()
-        
         return {
             "success": True,
             "new_balance": new_balance
@@ -1013,20 +1163,20 @@ async def apply_reward_voucher(request: ApplyRewardVoucherRequest):
         if not request.voucher_id and not request.voucher_code:
             raise HTTPException(status_code=400, detail="Voucher id or code is required")
 
-        query = supabase.table('reward_vouchers').select('*').eq('user_id', request.user_id).eq('status', 'active')
+        query = supabase.table('reward_vouchers').select('id,code,reward_type,expires_at').eq('user_id', request.user_id).eq('status', 'active')
         if request.voucher_id:
             query = query.eq('id', request.voucher_id)
         else:
             query = query.eq('code', request.voucher_code)
 
-        voucher_response = query.limit(1).execute()
+        voucher_response = await query.limit(1).execute()
         if not voucher_response.data:
             raise HTTPException(status_code=404, detail="Voucher not found or inactive")
 
         voucher = voucher_response.data[0]
         expires_at = parse_iso_datetime(voucher.get('expires_at'))
-        if expires_at and expires_at < datetime.utcnow():
-            supabase.table('reward_vouchers').update({
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            await supabase.table('reward_vouchers').update({
                 'status': 'expired',
             }).eq('id', voucher['id']).execute()
             raise HTTPException(status_code=400, detail="Voucher has expired")
@@ -1063,9 +1213,9 @@ async def apply_reward_voucher(request: ApplyRewardVoucherRequest):
 async def use_reward_voucher(request: UseRewardVoucherRequest):
     """Mark an active voucher as used after successful checkout."""
     try:
-        voucher_response = (
+        voucher_response = await (
             supabase.table('reward_vouchers')
-            .select('*')
+            .select('id,expires_at')
             .eq('id', request.voucher_id)
             .eq('user_id', request.user_id)
             .eq('status', 'active')
@@ -1078,13 +1228,13 @@ async def use_reward_voucher(request: UseRewardVoucherRequest):
 
         voucher = voucher_response.data[0]
         expires_at = parse_iso_datetime(voucher.get('expires_at'))
-        if expires_at and expires_at < datetime.utcnow():
-            supabase.table('reward_vouchers').update({
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            await supabase.table('reward_vouchers').update({
                 'status': 'expired',
             }).eq('id', request.voucher_id).execute()
             raise HTTPException(status_code=400, detail="Voucher has expired")
 
-        supabase.table('reward_vouchers').update({
+        await supabase.table('reward_vouchers').update({
             'status': 'used',
         }).eq('id', request.voucher_id).execute()
 
@@ -1105,59 +1255,32 @@ async def redeem_reward(request: RedeemRewardRequest):
     """Redeem loyalty points for a reward"""
     try:
         # Validate reward type and get points cost
-        reward_costs = {
-            'free_drink': 500,
-            'size_upgrade': 100,
-            'free_pastry': 300
-        }
-        
-        if request.reward_type not in reward_costs:
+        points_cost = REWARD_COSTS.get(request.reward_type)
+        if points_cost is None:
             raise HTTPException(status_code=400, detail="Invalid reward type")
         
-        points_cost = reward_costs[request.reward_type]
-        
-        # Get user's current points
-        points_response = supabase.table('loyalty_transactions').select('points_change').eq('user_id', request.user_id).execute()
-        total_points = sum(tx['points_change'] for tx in points_response.data) if points_response.data else 0
-        
-        if total_points < points_cost:
-            raise HTTPException(status_code=400, detail=f"Insufficient points. You have {total_points}, need {points_cost}")
-        
-        # Create negative loyalty transaction (deduct points)
-        reward_descriptions = {
-            'free_drink': 'Redeemed: Free Drink',
-            'size_upgrade': 'Redeemed: Size Upgrade',
-            'free_pastry': 'Redeemed: Free Pastry'
-        }
-        
-        tx = {
-            'id': str(uuid.uuid4()),
-            'user_id': request.user_id,
-            'points_change': -points_cost,
-            'transaction_type': 'redeem',
-            'description': reward_descriptions[request.reward_type],
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('loyalty_transactions').insert(tx).execute()
-        
-        # Create a reward voucher
-        voucher = {
-            'id': str(uuid.uuid4()),
-            'user_id': request.user_id,
-            'reward_type': request.reward_type,
-            'code': f"RWD-{uuid.uuid4().hex[:8].upper()}",
-            'status': 'active',
-            'expires_at': (datetime.utcnow().replace(day=1) + timedelta(days=32)).replace(day=1).isoformat(),  # End of next month
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('reward_vouchers').insert(voucher).execute()
+        # Check the balance, deduct the points and create the voucher in one
+        # transaction so concurrent redemptions can't both pass the check
+        voucher_code = f"RWD-{uuid.uuid4().hex[:8].upper()}"
+        redeem_response = await supabase.rpc('redeem_reward_and_log', {
+            'p_user': request.user_id,
+            'p_reward_type': request.reward_type,
+            'p_cost': points_cost,
+            'p_description': REWARD_DESCRIPTIONS[request.reward_type],
+            'p_code': voucher_code,
+            'p_expires_at': voucher_expiry(),  # End of next month
+        }).execute()
+        result = redeem_response.data
+        
+        if not result['redeemed']:
+            raise HTTPException(status_code=400, detail=f"Insufficient points. You have {result['points']}, need {points_cost}")
         
         return {
             "success": True,
-            "voucher_code": voucher['code'],
+            "voucher_code": voucher_code,
             "reward_type": request.reward_type,
             "points_deducted": points_cost,
-            "remaining_points": total_points - points_cost
+            "remaining_points": result['points']
         }
     except HTTPException:
         raise
@@ -1169,7 +1292,7 @@ async def redeem_reward(request: RedeemRewardRequest):
 async def get_user_vouchers(user_id: str):
     """Get user's active reward vouchers"""
     try:
-        response = supabase.table('reward_vouchers').select('*').eq('user_id', user_id).eq('status', 'active').execute()
+        response = await supabase.table('reward_vouchers').select(VOUCHER_COLUMNS).eq('user_id', user_id).eq('status', 'active').execute()
         return response.data if response.data else []
     except Exception as e:
         logger.error(f"Error fetching vouchers: {e}")
@@ -1191,53 +1314,26 @@ class GiftRedeem(BaseModel):
 async def send_gift(gift_data: GiftCreate):
     """Send a gift card to someone"""
     try:
-        # Check sender's wallet balance
-        wallet_response = supabase.table('wallets').select('*').eq('user_id', gift_data.sender_id).execute()
-        
-        if not wallet_response.data:
-            raise HTTPException(status_code=400, detail="Wallet not found. Please add funds first.")
-        
-        wallet = wallet_response.data[0]
-        if wallet['balance'] < gift_data.amount:
-            raise HTTPException(status_code=400, detail="Insufficient wallet balance")
-        
-        # Deduct from sender's wallet
-        new_balance = wallet['balance'] - gift_data.amount
-        supabase.table('wallets').update({
-            'balance': new_balance,
-            'updated_at': datetime.utcnow().isoformat()
-        }).eq('user_id', gift_data.sender_id).execute()
-        
-        # Create wallet transaction for sender
-        sender_tx = {
-            'id': str(uuid.uuid4()),
-            'user_id': gift_data.sender_id,
-            'amount': -gift_data.amount,
-            'type': 'gift_sent',
-            'description': f'Gift sent to {gift_data.recipient_email}',
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('wallet_transactions').insert(sender_tx).execute()
-        
-        # Create gift record
-        gift = {
-            'id': str(uuid.uuid4()),
-            'sender_id': gift_data.sender_id,
-            'recipient_email': gift_data.recipient_email,
-            'amount': gift_data.amount,
-            'message': gift_data.message,
-            'code': f"GIFT-{uuid.uuid4().hex[:8].upper()}",
-            'status': 'pending',
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('gifts').insert(gift).execute()
+        if gift_data.amount <= 0:
+            raise HTTPException(status_code=400, detail="Amount must be greater than 0")
+
+        # Debit the sender, log the transaction and create the gift in one transaction
+        gift_response = await supabase.rpc('send_gift_and_log', {
+            'p_sender': gift_data.sender_id,
+            'p_recipient_email': gift_data.recipient_email,
+            'p_amount': gift_data.amount,
+            'p_message': gift_data.message
+        }).execute()
+        gift = gift_response.data
+        if gift is None:
+            raise HTTPException(status_code=400, detail="Insufficient wallet balance. Please add funds first.")
         
         return {
             "success": True,
-            "gift_id": gift['id'],
-            "gift_code": gift['code'],
+            "gift_id": gift['gift_id'],
+            "gift_code": gift['gift_code'],
             "amount": gift_data.amount,
-            "new_wallet_balance": new_balance
+            "new_wallet_balance": gift['new_balance']
         }
     except HTTPException:
         raise
@@ -1249,15 +1345,13 @@ async def send_gift(gift_data: GiftCreate):
 async def get_user_gifts(user_id: str, user_email: Optional[str] = None):
     """Get gifts sent and received by user"""
     try:
-        # Get sent gifts
-        sent_response = supabase.table('gifts').select('*').eq('sender_id', user_id).order('created_at', desc=True).execute()
-        sent_gifts = sent_response.data if sent_response.data else []
-        
-        # Get received gifts (by email)
-        received_gifts = []
+        # Sent gifts and received gifts (by email) are independent, so fetch them concurrently
+        queries = [supabase.table('gifts').select(GIFT_COLUMNS).eq('sender_id', user_id).order('created_at', desc=True).execute()]
         if user_email:
-            received_response = supabase.table('gifts').select('*').eq('recipient_email', user_email).order('created_at', desc=True).execute()
-            received_gifts = received_response.data if received_response.data else []
+            queries.append(supabase.table('gifts').select(GIFT_COLUMNS).eq('recipient_email', user_email).order('created_at', desc=True).execute())
+        sent_response, *received = await asyncio.gather(*queries)
+        sent_gifts = sent_response.data if sent_response.data else []
+        received_gifts = received[0].data if received and received[0].data else []
         
         return {
             "sent": sent_gifts,
@@ -1271,61 +1365,23 @@ async def get_user_gifts(user_id: str, user_email: Optional[str] = None):
 async def redeem_gift(redeem_data: GiftRedeem):
     """Redeem a gift card"""
     try:
-        # Get the gift
-        gift_response = supabase.table('gifts').select('*').eq('id', redeem_data.gift_id).single().execute()
-        
-        if not gift_response.data:
+        # Claim the gift, credit the recipient and log the transaction in one transaction
+        redeem_response = await supabase.rpc('redeem_gift_and_log', {
+            'p_gift_id': redeem_data.gift_id,
+            'p_user': redeem_data.user_id
+        }).execute()
+        result = redeem_response.data
+        
+        if result is None:
             raise HTTPException(status_code=404, detail="Gift not found")
         
-        gift = gift_response.data
-        
-        if gift['status'] != 'pending':
+        if 'new_balance' not in result:
             raise HTTPException(status_code=400, detail="Gift has already been redeemed or expired")
         
-        # Add to recipient's wallet
-        wallet_response = supabase.table('wallets').select('*').eq('user_id', redeem_data.user_id).execute()
-        
-        if not wallet_response.data:
-            # Create wallet
-            new_wallet = {
-                'id': str(uuid.uuid4()),
-                'user_id': redeem_data.user_id,
-                'balance': gift['amount'],
-                'created_at': datetime.utcnow().isoformat(),
-                'updated_at': datetime.utcnow().isoformat()
-            }
-            supabase.table('wallets').insert(new_wallet).execute()
-            new_balance = gift['amount']
-        else:
-            wallet = wallet_response.data[0]
-            new_balance = wallet['balance'] + gift['amount']
-            supabase.table('wallets').update({
-                'balance': new_balance,
-                'updated_at': datetime.utcnow().isoformat()
-            }).eq('user_id', redeem_data.user_id).execute()
-        
-        # Create wallet transaction
-        tx = {
-            'id': str(uuid.uuid4()),
-            'user_id': redeem_data.user_id,
-            'amount': gift['amount'],
-            'type': 'gift_received',
-            'description': f'Gift card redeemed - ${gift["amount"]:.2f}',
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('wallet_transactions').insert(tx).execute()
-        
-        # Update gift status
-        supabase.table('gifts').update({
-            'status': 'redeemed',
-            'redeemed_by': redeem_data.user_id,
-            'redeemed_at': datetime.utcnow().isoformat()
-        }).eq('id', redeem_data.gift_id).execute()
-        
         return {
             "success": True,
-            "amount_added": gift['amount'],
-            "new_wallet_balance": new_balance
+            "amount_added": result['amount'],
+            "new_wallet_balance": result['new_balance']
         }
     except HTTPException:
         raise
@@ -1346,38 +1402,51 @@ class NotificationCreate(BaseModel):
 async def get_notifications(user_id: str, limit: int = 50):
     """Get user's notifications"""
     try:
-        response = supabase.table('notifications').select('*').eq('user_id', user_id).order('created_at', desc=True).limit(limit).execute()
+        response = await supabase.table('notifications').select('*').eq('user_id', user_id).order('created_at', desc=True).limit(limit).execute()
         return response.data if response.data else []
     except Exception as e:
         logger.error(f"Error fetching notifications: {e}")
         # Return empty list if table doesn't exist
         return []
 
+def build_notification(notification: NotificationCreate) -> Dict[str, Any]:
+    return {
+        'user_id': notification.user_id,
+        'title': notification.title,
+        'message': notification.message,
+        'type': notification.type,
+        'data': notification.data,
+        'read': False
+    }
+
 @api_router.post("/notifications")
 async def create_notification(notification: NotificationCreate):
     """Create a new notification"""
     try:
-        notif = {
-            'id': str(uuid.uuid4()),
-            'user_id': notification.user_id,
-            'title': notification.title,
-            'message': notification.message,
-            'type': notification.type,
-            'data': notification.data,
-            'read': False,
-            'created_at': datetime.utcnow().isoformat()
-        }
-        supabase.table('notifications').insert(notif).execute()
-        return notif
+        response = await supabase.table('notifications').insert(build_notification(notification)).execute()
+        return response.data[0]
     except Exception as e:
         logger.error(f"Error creating notification: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.post("/notifications/bulk")
+async def create_notifications_bulk(notifications: List[NotificationCreate]):
+    """Create many notifications (e.g. a promo fan-out) in a single insert"""
+    try:
+        if not notifications:
+            return []
+        notifs = [build_notification(notification) for notification in notifications]
+        response = await supabase.table('notifications').insert(notifs).execute()
+        return response.data
+    except Exception as e:
+        logger.error(f"Error creating notifications: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @api_router.patch("/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str):
     """Mark a notification as read"""
     try:
-        supabase.table('notifications').update({'read': True}).eq('id', notification_id).execute()
+        await supabase.table('notifications').update({'read': True}).eq('id', notification_id).execute()
         return {"success": True}
     except Exception as e:
         logger.error(f"Error marking notification read: {e}")
@@ -1387,7 +1456,8 @@ async def mark_notification_read(notification_id: str):
 async def mark_all_notifications_read(user_id: str):
     """Mark all user notifications as read"""
     try:
-        supabase.table('notifications').update({'read': True}).eq('user_id', user_id).execute()
+        # One UPDATE for the whole inbox, touching only rows that are still unread
+        await supabase.table('notifications').update({'read': True}).eq('user_id', user_id).eq('read', False).execute()
         return {"success": True}
     except Exception as e:
         logger.error(f"Error marking all notifications read: {e}")
@@ -1395,12 +1465,19 @@ async def mark_all_notifications_read(user_id: str):
 
 # ------------ Promos/Offers ------------
 
+PROMOS_CACHE_TTL_SECONDS = 300
+_promos_cache = TTLCache(maxsize=1, ttl=PROMOS_CACHE_TTL_SECONDS)
+
 @api_router.get("/promos")
 async def get_promos():
     """Get active promotions and offers"""
     try:
-        response = supabase.table('promos').select('*').eq('is_active', True).order('sort_order').execute()
+        if 'active' in _promos_cache:
+            return _promos_cache['active']
+
+        response = await supabase.table('promos').select('*').eq('is_active', True).order('sort_order').execute()
         if response.data:
+            _promos_cache['active'] = response.data
             return response.data
         # Return default promos if none in database
         return [
@@ -1463,6 +1540,71 @@ async def get_promos():
 
 # ------------ Advanced Search ------------
 
+POPULAR_SEARCHES = ('Latte', 'Espresso', 'Cold Brew', 'Matcha', 'Cappuccino', 'Americano', 'Mocha', 'Croissant')
+_POPULAR_SEARCHES_LOWER = tuple((term.lower(), term) for term in POPULAR_SEARCHES)
+
+_WORD_RE = re.compile(r'[^\W_]+')
+
+# Every trigram in the searchable catalog text, built per worker by a background
+# task started in the lifespan. A catalog write only invalidates the worker that
+# served it, so other workers rely on age instead: a set older than the catalog
+# cache TTL is ignored, the same staleness bound the shop/menu caches accept.
+# The task rebuilds well inside that window.
+SEARCH_TRIGRAMS_REFRESH_SECONDS = CATALOG_CACHE_TTL_SECONDS // 2
+_search_trigrams: Optional[frozenset] = None
+_search_trigrams_built_at = 0.0  # time.monotonic() when the rebuild's reads began
+_search_trigrams_stale = asyncio.Event()
+
+def text_trigrams(text: str) -> set:
+    """Trigrams a substring or pg_trgm similarity match could share with ``text``.
+
+    Covers raw substrings (ILIKE) plus pg_trgm's space-padded per-word trigrams.
+    """
+    text = text.lower()
+    grams = {text[i:i + 3] for i in range(len(text) - 2)}
+    for word in _WORD_RE.findall(text):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def current_search_trigrams() -> Optional[frozenset]:
+    """The trigram set, or None if it is missing or older than the catalog cache TTL."""
+    if _search_trigrams is None or time.monotonic() - _search_trigrams_built_at > CATALOG_CACHE_TTL_SECONDS:
+        return None
+    return _search_trigrams
+
+async def refresh_search_trigrams() -> None:
+    """Rebuild the trigram set from the searchable shop and menu item text."""
+    global _search_trigrams, _search_trigrams_built_at
+    started_at = time.monotonic()
+    shops_response, menu_response = await asyncio.gather(
+        supabase.table('shops').select('name,description,address').eq('is_active', True).execute(),
+        supabase.table('menu_items').select('name,description,category').eq('is_available', True).execute(),
+    )
+    grams = set()
+    for row in (shops_response.data or []) + (menu_response.data or []):
+        for value in row.values():
+            if value:
+                grams |= text_trigrams(value)
+    # A catalog write during the reads may be missing; leave the set cleared
+    # and let the next pass pick it up
+    if not _search_trigrams_stale.is_set():
+        _search_trigrams = frozenset(grams)
+        _search_trigrams_built_at = started_at
+
+async def keep_search_trigrams_fresh() -> None:
+    """Background task: build the trigram set, then rebuild it periodically or after catalog writes."""
+    while True:
+        _search_trigrams_stale.clear()
+        try:
+            await refresh_search_trigrams()
+        except Exception as e:
+            logger.warning(f"Failed to refresh search trigrams: {e}")
+        try:
+            await asyncio.wait_for(_search_trigrams_stale.wait(), SEARCH_TRIGRAMS_REFRESH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
 @api_router.get("/search")
 async def search(q: str, limit: int = 20):
     """Advanced search across shops and menu items"""
@@ -1477,90 +1619,23 @@ async def search(q: str, limit: int = 20):
         if not query:
             return results
         
-        # Search shops with fuzzy matching
-        shops_response = supabase.table('shops').select('*').eq('is_active', True).execute()
-        shops = shops_response.data if shops_response.data else []
-        
-        # Score and rank shops
-        scored_shops = []
-        for shop in shops:
-            score = 0
-            name_lower = shop['name'].lower()
-            desc_lower = (shop.get('description') or '').lower()
-            address_lower = (shop.get('address') or '').lower()
-            
-            # Exact match in name (highest priority)
-            if query == name_lower:
-                score += 100
-            # Starts with query
-            elif name_lower.startswith(query):
-                score += 80
-            # Contains query as whole word
-            elif f' {query} ' in f' {name_lower} ' or f' {query}' in f' {name_lower}' or f'{query} ' in f'{name_lower} ':
-                score += 60
-            # Contains query
-            elif query in name_lower:
-                score += 40
-            # Check description
-            if query in desc_lower:
-                score += 20
-            # Check address
-            if query in address_lower:
-                score += 10
-            
-            # Fuzzy matching for typos
-            if score == 0:
-                # Simple character overlap check
-                overlap = sum(1 for c in query if c in name_lower)
-                if overlap >= len(query) * 0.7:
-                    score += 15
-            
-            if score > 0:
-                scored_shops.append({**shop, '_score': score})
-        
-        # Sort by score descending
-        scored_shops.sort(key=lambda x: x['_score'], reverse=True)
-        results['shops'] = scored_shops[:limit]
-        
-        # Search menu items
-        menu_response = supabase.table('menu_items').select('*, shops(name)').eq('is_available', True).execute()
-        menu_items = menu_response.data if menu_response.data else []
-        
-        scored_items = []
-        for item in menu_items:
-            score = 0
-            name_lower = item['name'].lower()
-            desc_lower = (item.get('description') or '').lower()
-            category_lower = (item.get('category') or '').lower()
-            
-            if query == name_lower:
-                score += 100
-            elif name_lower.startswith(query):
-                score += 80
-            elif query in name_lower:
-                score += 50
-            if query in desc_lower:
-                score += 20
-            if query in category_lower:
-                score += 30
-            
-            if score > 0:
-                normalized_price = item.get('price')
-                if normalized_price is None:
-                    normalized_price = item.get('base_price')
-
-                scored_items.append({
-                    **item,
-                    'price': normalized_price,
-                    '_score': score
-                })
+        # Generate suggestions based on popular searches
+        results['suggestions'] = [term for lower, term in _POPULAR_SEARCHES_LOWER if query in lower][:5]
         
-        scored_items.sort(key=lambda x: x['_score'], reverse=True)
-        results['menu_items'] = scored_items[:limit]
+        # A query sharing no trigram with the catalog can't match anything, so
+        # skip both database searches (shorter queries always go to Postgres)
+        trigrams = current_search_trigrams()
+        if trigrams is not None and len(query) >= 3 and text_trigrams(query).isdisjoint(trigrams):
+            return results
         
-        # Generate suggestions based on popular searches
-        popular = ['Latte', 'Espresso', 'Cold Brew', 'Matcha', 'Cappuccino', 'Americano', 'Mocha', 'Croissant']
-        results['suggestions'] = [p for p in popular if query in p.lower()][:5]
+        # Ranking happens in Postgres (trigram-indexed), so only the top
+        # matches cross the wire instead of every active shop and menu item
+        shops_response, menu_response = await asyncio.gather(
+            supabase.rpc('search_shops', {'q': query, 'max_results': limit}).execute(),
+            supabase.rpc('search_menu_items', {'q': query, 'max_results': limit}).execute(),
+        )
+        results['shops'] = shops_response.data or []
+        results['menu_items'] = menu_response.data or []
         
         return results
     except Exception as e:
@@ -1577,10 +1652,12 @@ async def get_setup_instructions():
 
 -- Enable UUID extension
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 -- Shops table
 CREATE TABLE IF NOT EXISTS shops (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     name TEXT NOT NULL,
     description TEXT,
     logo_url TEXT,
@@ -1601,14 +1678,14 @@ CREATE TABLE IF NOT EXISTS shops (
 
 -- Menu items table
 CREATE TABLE IF NOT EXISTS menu_items (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     shop_id TEXT REFERENCES shops(id) ON DELETE CASCADE,
     name TEXT NOT NULL,
     description TEXT,
     category TEXT NOT NULL,
     base_price DECIMAL NOT NULL,
     image_url TEXT,
-    customization_options JSONB,
+    customization_options JSONB NOT NULL DEFAULT '{}'::JSONB,
     is_available BOOLEAN DEFAULT true,
     is_featured BOOLEAN DEFAULT false,
     sort_order INTEGER DEFAULT 0,
@@ -1617,7 +1694,7 @@ CREATE TABLE IF NOT EXISTS menu_items (
 
 -- Orders table
 CREATE TABLE IF NOT EXISTS orders (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     order_number TEXT UNIQUE,
     user_id TEXT NOT NULL,
     shop_id TEXT REFERENCES shops(id),
@@ -1638,7 +1715,7 @@ CREATE TABLE IF NOT EXISTS orders (
 
 -- Loyalty transactions table
 CREATE TABLE IF NOT EXISTS loyalty_transactions (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     user_id TEXT NOT NULL,
     shop_id TEXT REFERENCES shops(id),
     order_id TEXT REFERENCES orders(id),
@@ -1650,16 +1727,17 @@ CREATE TABLE IF NOT EXISTS loyalty_transactions (
 
 -- Wallets table
 CREATE TABLE IF NOT EXISTS wallets (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     user_id TEXT UNIQUE NOT NULL,
     balance DECIMAL DEFAULT 0,
+    stripe_customer_id TEXT,
     created_at TIMESTAMPTZ DEFAULT NOW(),
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
 -- Wallet transactions table
 CREATE TABLE IF NOT EXISTS wallet_transactions (
-    id TEXT PRIMARY KEY,
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
     user_id TEXT NOT NULL,
     amount DECIMAL NOT NULL,
     type TEXT NOT NULL,
@@ -1669,18 +1747,534 @@ CREATE TABLE IF NOT EXISTS wallet_transactions (
     created_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Running loyalty point balance per user, maintained by a trigger on loyalty_transactions
+CREATE TABLE IF NOT EXISTS user_loyalty (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Gift cards sent between users
+CREATE TABLE IF NOT EXISTS gifts (
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
+    sender_id TEXT NOT NULL,
+    recipient_email TEXT NOT NULL,
+    amount DECIMAL NOT NULL,
+    message TEXT,
+    code TEXT UNIQUE,
+    status TEXT DEFAULT 'pending',
+    redeemed_by TEXT,
+    redeemed_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- In-app notifications
+CREATE TABLE IF NOT EXISTS notifications (
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    message TEXT,
+    type TEXT,
+    data JSONB,
+    read BOOLEAN DEFAULT false,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Reward vouchers issued when loyalty points are redeemed
+CREATE TABLE IF NOT EXISTS reward_vouchers (
+    id TEXT PRIMARY KEY DEFAULT gen_random_uuid()::TEXT,
+    user_id TEXT NOT NULL,
+    reward_type TEXT NOT NULL,
+    code TEXT UNIQUE,
+    status TEXT DEFAULT 'active',
+    expires_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
 ALTER TABLE wallet_transactions ADD COLUMN IF NOT EXISTS payment_intent_id TEXT;
+ALTER TABLE shops ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE menu_items ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE orders ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE loyalty_transactions ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE wallets ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE wallet_transactions ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE notifications ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE notifications ALTER COLUMN created_at SET DEFAULT NOW();
+ALTER TABLE reward_vouchers ALTER COLUMN id SET DEFAULT gen_random_uuid()::TEXT;
+ALTER TABLE reward_vouchers ALTER COLUMN created_at SET DEFAULT NOW();
+ALTER TABLE wallets ADD COLUMN IF NOT EXISTS stripe_customer_id TEXT;
+UPDATE menu_items SET customization_options = '{}'::JSONB WHERE customization_options IS NULL;
+ALTER TABLE menu_items ALTER COLUMN customization_options SET DEFAULT '{}'::JSONB;
+ALTER TABLE menu_items ALTER COLUMN customization_options SET NOT NULL;
+ALTER TABLE wallets DROP COLUMN IF EXISTS lock_version;
+ALTER TABLE user_loyalty DROP COLUMN IF EXISTS version;
 
 -- Create indexes
 CREATE INDEX IF NOT EXISTS idx_menu_items_shop_id ON menu_items(shop_id);
+CREATE INDEX IF NOT EXISTS idx_shops_name_trgm ON shops USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_shops_description_trgm ON shops USING gin (description gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_shops_address_trgm ON shops USING gin (address gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_menu_items_name_trgm ON menu_items USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_menu_items_description_trgm ON menu_items USING gin (description gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_menu_items_category_trgm ON menu_items USING gin (category gin_trgm_ops);
 CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id);
+CREATE INDEX IF NOT EXISTS idx_orders_user_status_created ON orders(user_id, status, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_loyalty_user_id ON loyalty_transactions(user_id);
 CREATE INDEX IF NOT EXISTS idx_wallets_user_id ON wallets(user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_wallets_stripe_customer_id
+ON wallets(stripe_customer_id)
+WHERE stripe_customer_id IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_wallet_transactions_user_id ON wallet_transactions(user_id);
+CREATE INDEX IF NOT EXISTS idx_wallet_tx_user_created ON wallet_transactions(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_gifts_sender_created ON gifts(sender_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_gifts_recipient_created ON gifts(recipient_email, created_at DESC);
 CREATE UNIQUE INDEX IF NOT EXISTS idx_wallet_tx_payment_intent_id
 ON wallet_transactions(payment_intent_id)
 WHERE payment_intent_id IS NOT NULL;
 
+-- Total loyalty points for a user, read from the running balance
+CREATE OR REPLACE FUNCTION user_points(uid TEXT)
+RETURNS INTEGER
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE((SELECT balance FROM user_loyalty WHERE user_id = uid), 0);
+$$;
+
+-- Wallet balance (created on first access) with the 20 most recent transactions
+CREATE OR REPLACE FUNCTION get_wallet_with_tx(uid TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO wallets (id, user_id, balance)
+    VALUES (gen_random_uuid()::TEXT, uid, 0)
+    ON CONFLICT (user_id) DO NOTHING;
+
+    RETURN (
+        SELECT jsonb_build_object(
+            'balance', w.balance,
+            'transactions', COALESCE((
+                SELECT jsonb_agg(t ORDER BY t.created_at DESC)
+                FROM (
+                    SELECT id, amount, type, description, order_id, created_at
+                    FROM wallet_transactions
+                    WHERE user_id = uid
+                    ORDER BY created_at DESC
+                    LIMIT 20
+                ) t
+            ), '[]'::JSONB)
+        )
+        FROM wallets w
+        WHERE w.user_id = uid
+    );
+END;
+$$;
+
+-- Create an order and its loyalty earn transaction in a single transaction
+CREATE OR REPLACE FUNCTION place_order(p_order JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_order orders;
+BEGIN
+    new_order := jsonb_populate_record(NULL::orders, p_order);
+    new_order.id := COALESCE(new_order.id, gen_random_uuid()::TEXT);
+    new_order.order_number := COALESCE(new_order.order_number, 'ORD-' || upper(encode(gen_random_bytes(3), 'hex')));
+    new_order.shop_name := COALESCE((SELECT name FROM shops WHERE id = new_order.shop_id), 'Unknown Shop');
+    new_order.status := 'pending';
+    new_order.points_earned := COALESCE(new_order.points_earned, 0);
+    new_order.created_at := COALESCE(new_order.created_at, NOW());
+    new_order.updated_at := COALESCE(new_order.updated_at, new_order.created_at);
+
+    INSERT INTO orders SELECT new_order.*;
+
+    IF new_order.points_earned > 0 THEN
+        INSERT INTO loyalty_transactions (id, user_id, shop_id, order_id, points_change, transaction_type, description, created_at)
+        VALUES (
+            gen_random_uuid()::TEXT,
+            new_order.user_id,
+            new_order.shop_id,
+            new_order.id,
+            new_order.points_earned,
+            'earn',
+            'Order #' || new_order.order_number,
+            new_order.created_at
+        );
+    END IF;
+
+    RETURN to_jsonb(new_order);
+END;
+$$;
+
+-- Debit a wallet only if it holds enough funds; returns the new balance, or NULL when it doesn't
+CREATE OR REPLACE FUNCTION wallet_debit(uid TEXT, amt NUMERIC)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    IF amt IS NULL OR amt <= 0 THEN
+        RAISE EXCEPTION 'Debit amount must be greater than 0';
+    END IF;
+
+    UPDATE wallets
+    SET balance = balance - amt,
+        updated_at = NOW()
+    WHERE user_id = uid AND balance >= amt
+    RETURNING balance INTO new_balance;
+
+    RETURN new_balance;
+END;
+$$;
+
+-- Credit a wallet, creating it on first use; returns the new balance
+CREATE OR REPLACE FUNCTION wallet_credit(uid TEXT, amt NUMERIC)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    IF amt IS NULL OR amt <= 0 THEN
+        RAISE EXCEPTION 'Credit amount must be greater than 0';
+    END IF;
+
+    INSERT INTO wallets (id, user_id, balance)
+    VALUES (gen_random_uuid()::TEXT, uid, amt)
+    ON CONFLICT (user_id) DO UPDATE
+    SET balance = wallets.balance + EXCLUDED.balance,
+        updated_at = NOW()
+    RETURNING balance INTO new_balance;
+
+    RETURN new_balance;
+END;
+$$;
+
+-- Credit a Stripe top-up and record its wallet transaction in one transaction.
+-- Idempotent per payment intent: a repeat call returns the recorded transaction
+-- and current balance with applied = false instead of crediting twice.
+DROP FUNCTION IF EXISTS topup_and_log(TEXT, NUMERIC, TEXT);
+CREATE OR REPLACE FUNCTION topup_and_log(p_user TEXT, p_amount NUMERIC, p_pi TEXT)
+RETURNS TABLE(new_balance NUMERIC, tx_id TEXT, applied BOOLEAN)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description, payment_intent_id)
+    VALUES (gen_random_uuid()::TEXT, p_user, p_amount, 'topup', 'Added $' || to_char(p_amount, 'FM999999990.00') || ' to wallet', p_pi)
+    ON CONFLICT (payment_intent_id) WHERE payment_intent_id IS NOT NULL DO NOTHING
+    RETURNING id INTO tx_id;
+
+    applied := tx_id IS NOT NULL;
+    IF applied THEN
+        new_balance := wallet_credit(p_user, p_amount);
+    ELSE
+        SELECT t.id INTO tx_id FROM wallet_transactions t WHERE t.payment_intent_id = p_pi;
+        SELECT w.balance INTO new_balance FROM wallets w WHERE w.user_id = p_user;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$;
+
+-- Debit a wallet for an order and record the payment in one transaction; NULL when funds are short
+CREATE OR REPLACE FUNCTION pay_and_log(uid TEXT, amt NUMERIC, p_order_id TEXT)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    new_balance := wallet_debit(uid, amt);
+    IF new_balance IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description, order_id)
+    VALUES (gen_random_uuid()::TEXT, uid, -amt, 'payment', 'Order payment - $' || to_char(amt, 'FM999999990.00'), p_order_id);
+
+    RETURN new_balance;
+END;
+$$;
+
+-- Debit the sender, record the transaction and create the gift; NULL when funds are short
+CREATE OR REPLACE FUNCTION send_gift_and_log(p_sender TEXT, p_recipient_email TEXT, p_amount NUMERIC, p_message TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_balance NUMERIC;
+    new_gift_id TEXT;
+    new_gift_code TEXT;
+BEGIN
+    new_balance := wallet_debit(p_sender, p_amount);
+    IF new_balance IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description)
+    VALUES (gen_random_uuid()::TEXT, p_sender, -p_amount, 'gift_sent', 'Gift sent to ' || p_recipient_email);
+
+    INSERT INTO gifts (id, sender_id, recipient_email, amount, message, code, status)
+    VALUES (
+        gen_random_uuid()::TEXT,
+        p_sender,
+        p_recipient_email,
+        p_amount,
+        p_message,
+        'GIFT-' || upper(encode(gen_random_bytes(4), 'hex')),
+        'pending'
+    )
+    RETURNING id, code INTO new_gift_id, new_gift_code;
+
+    RETURN jsonb_build_object(
+        'gift_id', new_gift_id,
+        'gift_code', new_gift_code,
+        'new_balance', new_balance
+    );
+END;
+$$;
+
+-- Claim a pending gift and credit the recipient; NULL when the gift doesn't exist,
+-- {'status': ...} when it is no longer pending
+CREATE OR REPLACE FUNCTION redeem_gift_and_log(p_gift_id TEXT, p_user TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    gift_amount NUMERIC;
+    gift_status TEXT;
+    new_balance NUMERIC;
+BEGIN
+    UPDATE gifts
+    SET status = 'redeemed',
+        redeemed_by = p_user,
+        redeemed_at = NOW()
+    WHERE id = p_gift_id AND status = 'pending'
+    RETURNING amount INTO gift_amount;
+
+    IF gift_amount IS NULL THEN
+        SELECT status INTO gift_status FROM gifts WHERE id = p_gift_id;
+        IF gift_status IS NULL THEN
+            RETURN NULL;
+        END IF;
+        RETURN jsonb_build_object('status', gift_status);
+    END IF;
+
+    new_balance := wallet_credit(p_user, gift_amount);
+
+    INSERT INTO wallet_transactions (id, user_id, amount, type, description)
+    VALUES (gen_random_uuid()::TEXT, p_user, gift_amount, 'gift_received', 'Gift card redeemed - $' || to_char(gift_amount, 'FM999999990.00'));
+
+    RETURN jsonb_build_object(
+        'status', 'redeemed',
+        'amount', gift_amount,
+        'new_balance', new_balance
+    );
+END;
+$$;
+
+-- Keep user_loyalty.balance in step with every loyalty transaction
+CREATE OR REPLACE FUNCTION apply_loyalty_transaction()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO user_loyalty (user_id, balance, updated_at)
+    VALUES (NEW.user_id, NEW.points_change, NOW())
+    ON CONFLICT (user_id) DO UPDATE
+    SET balance = user_loyalty.balance + EXCLUDED.balance,
+        updated_at = NOW();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS loyalty_transactions_apply_balance ON loyalty_transactions;
+CREATE TRIGGER loyalty_transactions_apply_balance
+AFTER INSERT ON loyalty_transactions
+FOR EACH ROW EXECUTE FUNCTION apply_loyalty_transaction();
+
+-- Backfill balances for users whose history predates the trigger
+INSERT INTO user_loyalty (user_id, balance)
+SELECT user_id, SUM(points_change)::INTEGER
+FROM loyalty_transactions
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
+
+-- Spend loyalty points on a reward voucher. The user's balance row is locked for
+-- the check, so concurrent redemptions queue instead of both passing it. Returns
+-- {'redeemed': false, 'points': balance} when the balance is short, otherwise
+-- {'redeemed': true, 'points': remaining balance}.
+CREATE OR REPLACE FUNCTION redeem_reward_and_log(
+    p_user TEXT,
+    p_reward_type TEXT,
+    p_cost INTEGER,
+    p_description TEXT,
+    p_code TEXT,
+    p_expires_at TIMESTAMPTZ
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    current_points INTEGER;
+BEGIN
+    SELECT balance INTO current_points FROM user_loyalty WHERE user_id = p_user FOR UPDATE;
+    current_points := COALESCE(current_points, 0);
+
+    IF current_points < p_cost THEN
+        RETURN jsonb_build_object('redeemed', false, 'points', current_points);
+    END IF;
+
+    -- The loyalty_transactions trigger deducts the points from user_loyalty
+    INSERT INTO loyalty_transactions (id, user_id, points_change, transaction_type, description)
+    VALUES (gen_random_uuid()::TEXT, p_user, -p_cost, 'redeem', p_description);
+
+    INSERT INTO reward_vouchers (id, user_id, reward_type, code, status, expires_at)
+    VALUES (gen_random_uuid()::TEXT, p_user, p_reward_type, p_code, 'active', p_expires_at);
+
+    RETURN jsonb_build_object('redeemed', true, 'points', current_points - p_cost);
+END;
+$$;
+
+-- Ranked shop search. Scores mirror the original Python ranking; trigram
+-- similarity on the name stands in for the old character-overlap typo check.
+CREATE OR REPLACE FUNCTION search_shops(q TEXT, max_results INTEGER DEFAULT 20)
+RETURNS SETOF JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH params AS (
+        SELECT lower(btrim(q)) AS term
+    ),
+    patterns AS (
+        SELECT term, '%' || replace(replace(replace(term, '!', '!!'), '%', '!%'), '_', '!_') || '%' AS pattern
+        FROM params
+    ),
+    matches AS (
+        SELECT s AS shop,
+            CASE
+                WHEN lower(s.name) = p.term THEN 100
+                WHEN starts_with(lower(s.name), p.term) THEN 80
+                WHEN strpos(' ' || lower(s.name), ' ' || p.term) > 0
+                  OR strpos(lower(s.name) || ' ', p.term || ' ') > 0 THEN 60
+                WHEN strpos(lower(s.name), p.term) > 0 THEN 40
+                ELSE 0
+            END
+            + CASE WHEN strpos(lower(COALESCE(s.description, '')), p.term) > 0 THEN 20 ELSE 0 END
+            + CASE WHEN strpos(lower(COALESCE(s.address, '')), p.term) > 0 THEN 10 ELSE 0 END AS score
+        FROM shops s, patterns p
+        WHERE p.term <> ''
+          AND s.is_active
+          AND (s.name ILIKE p.pattern ESCAPE '!'
+               OR s.description ILIKE p.pattern ESCAPE '!'
+               OR s.address ILIKE p.pattern ESCAPE '!'
+               OR s.name % p.term)
+    )
+    SELECT to_jsonb(shop) || jsonb_build_object('_score', CASE WHEN score = 0 THEN 15 ELSE score END)
+    FROM matches
+    ORDER BY CASE WHEN score = 0 THEN 15 ELSE score END DESC, (shop).name
+    LIMIT max_results;
+$$;
+
+-- Ranked menu item search across available items, with the shop name embedded
+CREATE OR REPLACE FUNCTION search_menu_items(q TEXT, max_results INTEGER DEFAULT 20)
+RETURNS SETOF JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH params AS (
+        SELECT lower(btrim(q)) AS term
+    ),
+    patterns AS (
+        SELECT term, '%' || replace(replace(replace(term, '!', '!!'), '%', '!%'), '_', '!_') || '%' AS pattern
+        FROM params
+    ),
+    matches AS (
+        SELECT m AS item, s.name AS shop_name,
+            CASE
+                WHEN lower(m.name) = p.term THEN 100
+                WHEN starts_with(lower(m.name), p.term) THEN 80
+                WHEN strpos(lower(m.name), p.term) > 0 THEN 50
+                ELSE 0
+            END
+            + CASE WHEN strpos(lower(COALESCE(m.description, '')), p.term) > 0 THEN 20 ELSE 0 END
+            + CASE WHEN strpos(lower(COALESCE(m.category, '')), p.term) > 0 THEN 30 ELSE 0 END AS score
+        FROM menu_items m
+        CROSS JOIN patterns p
+        LEFT JOIN shops s ON s.id = m.shop_id
+        WHERE p.term <> ''
+          AND m.is_available
+          AND (m.name ILIKE p.pattern ESCAPE '!'
+               OR m.description ILIKE p.pattern ESCAPE '!'
+               OR m.category ILIKE p.pattern ESCAPE '!')
+    )
+    SELECT to_jsonb(item) || jsonb_build_object(
+        'price', (item).base_price,
+        'shops', CASE WHEN shop_name IS NULL THEN NULL ELSE jsonb_build_object('name', shop_name) END,
+        '_score', score
+    )
+    FROM matches
+    ORDER BY score DESC, (item).name
+    LIMIT max_results;
+$$;
+
+-- Stamp updated_at on every row update so callers don't have to send it
+CREATE OR REPLACE FUNCTION set_updated_at()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS orders_set_updated_at ON orders;
+CREATE TRIGGER orders_set_updated_at
+BEFORE UPDATE ON orders
+FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+DROP TRIGGER IF EXISTS wallets_set_updated_at ON wallets;
+CREATE TRIGGER wallets_set_updated_at
+BEFORE UPDATE ON wallets
+FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+-- Replace the demo catalog with the given shops and menu items in one transaction.
+-- The TEXT-argument variant is dropped so PostgREST resolves a single function.
+DROP FUNCTION IF EXISTS seed_database(TEXT, TEXT);
+CREATE OR REPLACE FUNCTION seed_database(p_shops JSONB, p_items JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    shops_created INTEGER;
+    items_created INTEGER;
+BEGIN
+    DELETE FROM menu_items WHERE id IS NOT NULL;
+    DELETE FROM shops WHERE id IS NOT NULL;
+
+    INSERT INTO shops
+    SELECT * FROM jsonb_populate_recordset(NULL::shops, p_shops);
+    GET DIAGNOSTICS shops_created = ROW_COUNT;
+
+    -- Items without customization options omit the key; give them the column's empty default
+    INSERT INTO menu_items
+    SELECT m.*
+    FROM jsonb_array_elements(p_items) AS item,
+         jsonb_populate_record(NULL::menu_items, '{"customization_options": {}}'::JSONB || item) AS m;
+    GET DIAGNOSTICS items_created = ROW_COUNT;
+
+    RETURN jsonb_build_object(
+        'shops_created', shops_created,
+        'menu_items_created', items_created
+    );
+END;
+$$;
+
 -- Wallet RLS policies
 ALTER TABLE wallets ENABLE ROW LEVEL SECURITY;
 ALTER TABLE wallet_transactions ENABLE ROW LEVEL SECURITY;
@@ -1727,13 +2321,174 @@ WITH CHECK (auth.uid()::TEXT = user_id);
         "sql": sql
     }
 
+# Option lists shared by several menu items
+_SIZE_OPTIONS = ("Small (-$1.00)", "Medium (default)", "Large (+$1.00)")
+_HOUSE_BEAN_OPTIONS = ("Brazil (default)", "Ethiopia (+$1.00)")
+_MILK_OPTIONS = ("Whole (default)", "Oat (+$0.50)", "Almond (+$0.50)")
+_ICE_OPTIONS = ("Light", "Regular (default)", "Extra")
+
+# Menu every seeded shop gets; read-only so requests can share it
+_MENU_ITEMS_TEMPLATE = (
+    MappingProxyType({
+        "name": "Latte",
+        "description": "Espresso with steamed milk. Our signature drink with smooth, velvety texture.",
+        "category": "espresso",
+        "base_price": 5.00,
+        "is_available": True,
+        "is_featured": True,
+        "sort_order": 1,
+        "customization_options": {
+            "beans": ("Brazil (default)", "Ethiopia (+$1.00)", "Colombia (+$0.50)"),
+            "milk": ("Whole (default)", "Oat (+$0.50)", "Almond (+$0.50)", "Soy (+$0.50)"),
+            "size": _SIZE_OPTIONS,
+            "shots": ("1 (-$0.50)", "2 (default)", "3 (+$0.50)"),
+        },
+    }),
+    MappingProxyType({
+        "name": "Cappuccino",
+        "description": "Espresso with foamed milk. Classic Italian style.",
+        "category": "espresso",
+        "base_price": 4.75,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 2,
+        "customization_options": {
+            "beans": _HOUSE_BEAN_OPTIONS,
+            "milk": ("Whole (default)", "Oat (+$0.50)"),
+            "size": ("Small (-$0.75)", "Medium (default)", "Large (+$0.75)"),
+        },
+    }),
+    MappingProxyType({
+        "name": "Americano",
+        "description": "Espresso diluted with hot water. Bold and smooth.",
+        "category": "espresso",
+        "base_price": 3.50,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 3,
+        "customization_options": {
+            "beans": _HOUSE_BEAN_OPTIONS,
+            "size": ("Small (-$0.50)", "Medium (default)", "Large (+$0.50)"),
+            "shots": ("1", "2 (default)", "3 (+$0.50)"),
+        },
+    }),
+    MappingProxyType({
+        "name": "Cold Brew",
+        "description": "Smooth cold-steeped coffee. Refreshing and bold.",
+        "category": "cold_brew",
+        "base_price": 5.50,
+        "is_available": True,
+        "is_featured": True,
+        "sort_order": 4,
+        "customization_options": {
+            "size": _SIZE_OPTIONS,
+            "ice": _ICE_OPTIONS,
+            "sweetness": ("None (default)", "1 pump (+$0.25)", "2 pumps (+$0.50)"),
+        },
+    }),
+    MappingProxyType({
+        "name": "Iced Latte",
+        "description": "Espresso with cold milk over ice. Perfect for warm days.",
+        "category": "cold_brew",
+        "base_price": 5.25,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 5,
+        "customization_options": {
+            "beans": _HOUSE_BEAN_OPTIONS,
+            "milk": _MILK_OPTIONS,
+            "size": _SIZE_OPTIONS,
+            "ice": _ICE_OPTIONS,
+        },
+    }),
+    MappingProxyType({
+        "name": "Matcha Latte",
+        "description": "Premium ceremonial grade matcha with steamed milk.",
+        "category": "specialty",
+        "base_price": 6.00,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 6,
+        "customization_options": {
+            "milk": _MILK_OPTIONS,
+            "size": _SIZE_OPTIONS,
+            "sweetness": ("None", "Light (default)", "Regular", "Extra"),
+        },
+    }),
+    MappingProxyType({
+        "name": "Chai Latte",
+        "description": "Spiced tea with steamed milk. Warm and comforting.",
+        "category": "specialty",
+        "base_price": 5.50,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 7,
+        "customization_options": {
+            "milk": _MILK_OPTIONS,
+            "size": _SIZE_OPTIONS,
+            "sweetness": ("Light", "Regular (default)", "Extra"),
+        },
+    }),
+    MappingProxyType({
+        "name": "Croissant",
+        "description": "Buttery, flaky French pastry. Freshly baked daily.",
+        "category": "pastry",
+        "base_price": 3.50,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 8,
+    }),
+    MappingProxyType({
+        "name": "Almond Croissant",
+        "description": "Classic croissant filled with almond cream.",
+        "category": "pastry",
+        "base_price": 4.25,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 9,
+    }),
+    MappingProxyType({
+        "name": "Blueberry Muffin",
+        "description": "Moist muffin loaded with fresh blueberries.",
+        "category": "pastry",
+        "base_price": 3.75,
+        "is_available": True,
+        "is_featured": False,
+        "sort_order": 10,
+    }),
+)
+
+# Menu item ids are "menu-<shop id>-<sort order>"; the per-item suffix never changes.
+# Each template is also pre-encoded as the JSON members between its braces, so a
+# seed request only encodes the per-row id, shop_id and created_at.
+def _json_fields(item: MappingProxyType) -> bytes:
+    """Serialized members of ``item`` with a leading comma, or b'' if it has none."""
+    body = orjson.dumps(dict(item))[1:-1]
+    return b',' + body if body else b''
+
+_MENU_ITEMS_JSON = tuple(
+    (f"-{item['sort_order']}", _json_fields(item))
+    for item in _MENU_ITEMS_TEMPLATE
+)
+
+def seed_menu_items_json(shop_ids: List[str], created_at: str) -> bytes:
+    """JSON array of every template menu item for each shop."""
+    created_at_json = orjson.dumps(created_at)
+    rows = [
+        b'{"id":' + orjson.dumps("menu-" + shop_id + id_suffix)
+        + b',"shop_id":' + orjson.dumps(shop_id)
+        + item_fields
+        + b',"created_at":' + created_at_json + b'}'
+        for shop_id, (id_suffix, item_fields) in product(shop_ids, _MENU_ITEMS_JSON)
+    ]
+    return b'[' + b','.join(rows) + b']'
+
 @api_router.post("/seed")
 async def seed_database():
     """Seed the database with sample data"""
     try:
-        # Clear existing data
-        supabase.table('menu_items').delete().neq('id', '').execute()
-        supabase.table('shops').delete().neq('id', '').execute()
+        # One timestamp for every seeded row
+        created_at = utc_now_iso()
         
         # Create sample shops
         shops_data = [
@@ -1758,7 +2513,7 @@ async def seed_database():
                     "sunday": {"open": "08:00", "close": "17:00"},
                 },
                 "loyalty_multiplier": 1.0,
-                "created_at": datetime.utcnow().isoformat(),
+                "created_at": created_at,
             },
             {
                 "id": "shop-2",
@@ -1781,7 +2536,7 @@ async def seed_database():
                     "sunday": {"open": "09:00", "close": "18:00"},
                 },
                 "loyalty_multiplier": 1.5,
-                "created_at": datetime.utcnow().isoformat(),
+                "created_at": created_at,
             },
             {
                 "id": "shop-3",
@@ -1804,172 +2559,66 @@ async def seed_database():
                     "sunday": {"open": "08:00", "close": "18:00"},
                 },
                 "loyalty_multiplier": 2.0,
-                "created_at": datetime.utcnow().isoformat(),
+                "created_at": created_at,
             },
         ]
         
-        supabase.table('shops').insert(shops_data).execute()
-        
-        # Create sample menu items for each shop
-        menu_items_template = [
-            {
-                "name": "Latte",
-                "description": "Espresso with steamed milk. Our signature drink with smooth, velvety texture.",
-                "category": "espresso",
-                "base_price": 5.00,
-                "is_available": True,
-                "is_featured": True,
-                "sort_order": 1,
-                "customization_options": {
-                    "beans": ["Brazil (default)", "Ethiopia (+$1.00)", "Colombia (+$0.50)"],
-                    "milk": ["Whole (default)", "Oat (+$0.50)", "Almond (+$0.50)", "Soy (+$0.50)"],
-                    "size": ["Small (-$1.00)", "Medium (default)", "Large (+$1.00)"],
-                    "shots": ["1 (-$0.50)", "2 (default)", "3 (+$0.50)"],
-                },
-            },
-            {
-                "name": "Cappuccino",
-                "description": "Espresso with foamed milk. Classic Italian style.",
-                "category": "espresso",
-                "base_price": 4.75,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 2,
-                "customization_options": {
-                    "beans": ["Brazil (default)", "Ethiopia (+$1.00)"],
-                    "milk": ["Whole (default)", "Oat (+$0.50)"],
-                    "size": ["Small (-$0.75)", "Medium (default)", "Large (+$0.75)"],
-                },
-            },
-            {
-                "name": "Americano",
-                "description": "Espresso diluted with hot water. Bold and smooth.",
-                "category": "espresso",
-                "base_price": 3.50,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 3,
-                "customization_options": {
-                    "beans": ["Brazil (default)", "Ethiopia (+$1.00)"],
-                    "size": ["Small (-$0.50)", "Medium (default)", "Large (+$0.50)"],
-                    "shots": ["1", "2 (default)", "3 (+$0.50)"],
-                },
-            },
-            {
-                "name": "Cold Brew",
-                "description": "Smooth cold-steeped coffee. Refreshing and bold.",
-                "category": "cold_brew",
-                "base_price": 5.50,
-                "is_available": True,
-                "is_featured": True,
-                "sort_order": 4,
-                "customization_options": {
-                    "size": ["Small (-$1.00)", "Medium (default)", "Large (+$1.00)"],
-                    "ice": ["Light", "Regular (default)", "Extra"],
-                    "sweetness": ["None (default)", "1 pump (+$0.25)", "2 pumps (+$0.50)"],
-                },
-            },
-            {
-                "name": "Iced Latte",
-                "description": "Espresso with cold milk over ice. Perfect for warm days.",
-                "category": "cold_brew",
-                "base_price": 5.25,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 5,
-                "customization_options": {
-                    "beans": ["Brazil (default)", "Ethiopia (+$1.00)"],
-                    "milk": ["Whole (default)", "Oat (+$0.50)", "Almond (+$0.50)"],
-                    "size": ["Small (-$1.00)", "Medium (default)", "Large (+$1.00)"],
-                    "ice": ["Light", "Regular (default)", "Extra"],
-                },
-            },
-            {
-                "name": "Matcha Latte",
-                "description": "Premium ceremonial grade matcha with steamed milk.",
-                "category": "specialty",
-                "base_price": 6.00,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 6,
-                "customization_options": {
-                    "milk": ["Whole (default)", "Oat (+$0.50)", "Almond (+$0.50)"],
-                    "size": ["Small (-$1.00)", "Medium (default)", "Large (+$1.00)"],
-                    "sweetness": ["None", "Light (default)", "Regular", "Extra"],
-                },
-            },
-            {
-                "name": "Chai Latte",
-                "description": "Spiced tea with steamed milk. Warm and comforting.",
-                "category": "specialty",
-                "base_price": 5.50,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 7,
-                "customization_options": {
-                    "milk": ["Whole (default)", "Oat (+$0.50)", "Almond (+$0.50)"],
-                    "size": ["Small (-$1.00)", "Medium (default)", "Large (+$1.00)"],
-                    "sweetness": ["Light", "Regular (default)", "Extra"],
-                },
-            },
-            {
-                "name": "Croissant",
-                "description": "Buttery, flaky French pastry. Freshly baked daily.",
-                "category": "pastry",
-                "base_price": 3.50,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 8,
-            },
-            {
-                "name": "Almond Croissant",
-                "description": "Classic croissant filled with almond cream.",
-                "category": "pastry",
-                "base_price": 4.25,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 9,
-            },
-            {
-                "name": "Blueberry Muffin",
-                "description": "Moist muffin loaded with fresh blueberries.",
-                "category": "pastry",
-                "base_price": 3.75,
-                "is_available": True,
-                "is_featured": False,
-                "sort_order": 10,
+        # Clearing the old catalog and inserting shops and menu items happen in
+        # one database transaction and a single round trip. The body is encoded
+        # with orjson and posted straight to the RPC endpoint on the shared pool,
+        # so the client's stdlib JSON encoder never walks the payload.
+        body = (
+            b'{"p_shops":' + orjson.dumps(shops_data)
+            + b',"p_items":' + seed_menu_items_json([shop["id"] for shop in shops_data], created_at)
+            + b'}'
+        )
+        response = await http_client.post(
+            f"{supabase_url.rstrip('/')}/rest/v1/rpc/seed_database",
+            content=body,
+            headers={
+                'apikey': supabase_key,
+                'Authorization': f'Bearer {supabase_key}',
+                'Content-Type': 'application/json',
             },
-        ]
-        
-        menu_items_to_insert = []
-        for shop_data in shops_data:
-            for item_template in menu_items_template:
-                menu_item = {
-                    "id": f"menu-{shop_data['id']}-{item_template['sort_order']}",
-                    "shop_id": shop_data["id"],
-                    **item_template,
-                    "created_at": datetime.utcnow().isoformat(),
-                }
-                menu_items_to_insert.append(menu_item)
-        
-        supabase.table('menu_items').insert(menu_items_to_insert).execute()
+        )
+        response.raise_for_status()
+        counts = orjson.loads(response.content)
+        invalidate_catalog_cache()
         
         return {
             "message": "Database seeded successfully",
-            "shops_created": len(shops_data),
-            "menu_items_created": len(menu_items_to_insert)
+            "shops_created": counts['shops_created'],
+            "menu_items_created": counts['menu_items_created']
         }
-    except Exception as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error seeding database: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# Include the router in the main app
-app.include_router(api_router)
+# CORS_ALLOW_ORIGINS: comma-separated list of browser origins allowed to call the
+# API, e.g. "https://example.com,http://localhost:8081". Defaults to the Expo web
+# dev server only; native app requests carry no Origin and are unaffected.
+# "*" is accepted for local testing, but credentials are then turned off since
+# browsers must not send cookies/auth headers to a wildcard origin.
+DEFAULT_CORS_ALLOW_ORIGINS = 'http://localhost:8081'
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in os.environ.get('CORS_ALLOW_ORIGINS', DEFAULT_CORS_ALLOW_ORIGINS).split(',')
+    if origin.strip()
+]
+CORS_ALLOW_CREDENTIALS = '*' not in CORS_ALLOW_ORIGINS
+if not CORS_ALLOW_CREDENTIALS:
+    logger.warning("CORS_ALLOW_ORIGINS contains '*'. Allowing any origin without credentials.")
+# Let browsers reuse a preflight response for a day instead of re-sending OPTIONS
+CORS_MAX_AGE_SECONDS = 86400
 
 app.add_middleware(
     CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_credentials=CORS_ALLOW_CREDENTIALS,
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_methods=["GET", "POST", "PATCH", "DELETE"],
+    allow_headers=["authorization", "content-type"],
+    max_age=CORS_MAX_AGE_SECONDS,
 )
+
+# Include the router in the main app
+app.include_router(api_router)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# backend/server.py is a standalone module rather than a package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'backend'))
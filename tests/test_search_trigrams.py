@@ -0,0 +1,33 @@
+from server import text_trigrams
+
+CATALOG_TEXT = [
+    "Caramel Macchiato",
+    "Oat Milk Latte (Iced)",
+    "Rich espresso with steamed milk & vanilla",
+    "123 Main St., Brooklyn",
+    "Café Crème",
+    "cold_brew",
+]
+
+
+def catalog_trigrams():
+    grams = set()
+    for text in CATALOG_TEXT:
+        grams |= text_trigrams(text)
+    return frozenset(grams)
+
+
+def test_catalog_substrings_are_never_filtered_out():
+    trigrams = catalog_trigrams()
+    for text in CATALOG_TEXT:
+        for start in range(len(text)):
+            for end in range(start + 3, len(text) + 1):
+                # /search lowercases and strips the query before filtering
+                query = text[start:end].lower().strip()
+                if len(query) < 3:
+                    continue
+                assert not text_trigrams(query).isdisjoint(trigrams), query
+
+
+def test_unrelated_query_is_filtered_out():
+    assert text_trigrams("zzqx").isdisjoint(catalog_trigrams())
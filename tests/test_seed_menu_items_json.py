@@ -0,0 +1,34 @@
+import json
+
+from server import _MENU_ITEMS_TEMPLATE, seed_menu_items_json
+
+CREATED_AT = "2024-01-01T00:00:00+00:00"
+
+
+def dict_rows(shop_ids):
+    rows = [
+        {
+            "id": f"menu-{shop_id}-{item['sort_order']}",
+            "shop_id": shop_id,
+            **item,
+            "created_at": CREATED_AT,
+        }
+        for shop_id in shop_ids
+        for item in _MENU_ITEMS_TEMPLATE
+    ]
+    # Round-trip so tuples compare equal to the lists json.loads returns
+    return json.loads(json.dumps(rows))
+
+
+def test_matches_dict_built_rows():
+    shop_ids = ["shop-1", "shop-2"]
+    assert json.loads(seed_menu_items_json(shop_ids, CREATED_AT)) == dict_rows(shop_ids)
+
+
+def test_escapes_shop_ids():
+    shop_ids = ['shop-"quoted"', "shop\\slash", "café-☕"]
+    assert json.loads(seed_menu_items_json(shop_ids, CREATED_AT)) == dict_rows(shop_ids)
+
+
+def test_no_shops():
+    assert json.loads(seed_menu_items_json([], CREATED_AT)) == []